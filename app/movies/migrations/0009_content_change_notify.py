@@ -0,0 +1,58 @@
+from django.db import migrations
+
+TABLES = ('film_work', 'genre', 'person', 'genre_film_work', 'person_film_work')
+
+NOTIFY_FUNCTION = """
+CREATE OR REPLACE FUNCTION content.notify_content_change() RETURNS trigger AS $$
+DECLARE
+    row_data jsonb;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_data := to_jsonb(OLD);
+    ELSE
+        row_data := to_jsonb(NEW);
+    END IF;
+
+    PERFORM pg_notify(
+        'content_changed',
+        json_build_object(
+            'table', TG_TABLE_NAME,
+            'op', TG_OP,
+            'id', row_data->>'id',
+            'film_work_id', row_data->>'film_work_id'
+        )::text
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def create_triggers_sql():
+    return [NOTIFY_FUNCTION] + [
+        f'CREATE TRIGGER {table}_notify_change '
+        f'AFTER INSERT OR UPDATE OR DELETE ON content.{table} '
+        'FOR EACH ROW EXECUTE FUNCTION content.notify_content_change();'
+        for table in TABLES
+    ]
+
+
+def drop_triggers_sql():
+    return [
+        f'DROP TRIGGER IF EXISTS {table}_notify_change ON content.{table};'
+        for table in TABLES
+    ] + ['DROP FUNCTION IF EXISTS content.notify_content_change();']
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0008_filmwork_film_work_modified_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=create_triggers_sql(),
+            reverse_sql=drop_triggers_sql(),
+        ),
+    ]
@@ -0,0 +1,74 @@
+from django.db import migrations
+
+TABLES = ('film_work', 'genre', 'person', 'genre_film_work', 'person_film_work')
+
+CHANGE_LOG_TABLE = """
+CREATE TABLE IF NOT EXISTS content.change_log (
+    seq BIGSERIAL PRIMARY KEY,
+    table_name TEXT NOT NULL,
+    op TEXT NOT NULL,
+    entity_id UUID NOT NULL,
+    film_work_id UUID,
+    txid BIGINT NOT NULL DEFAULT txid_current(),
+    created TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+"""
+
+LOG_FUNCTION = """
+CREATE OR REPLACE FUNCTION content.log_content_change() RETURNS trigger AS $$
+DECLARE
+    row_data jsonb;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_data := to_jsonb(OLD);
+    ELSE
+        row_data := to_jsonb(NEW);
+    END IF;
+
+    INSERT INTO content.change_log (table_name, op, entity_id, film_work_id)
+    VALUES (
+        TG_TABLE_NAME,
+        TG_OP,
+        (row_data->>'id')::uuid,
+        CASE
+            WHEN TG_TABLE_NAME = 'film_work' THEN (row_data->>'id')::uuid
+            ELSE (row_data->>'film_work_id')::uuid
+        END
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def create_change_log_sql():
+    return [CHANGE_LOG_TABLE, LOG_FUNCTION] + [
+        f'CREATE TRIGGER {table}_log_change '
+        f'AFTER INSERT OR UPDATE OR DELETE ON content.{table} '
+        'FOR EACH ROW EXECUTE FUNCTION content.log_content_change();'
+        for table in TABLES
+    ]
+
+
+def drop_change_log_sql():
+    return [
+        f'DROP TRIGGER IF EXISTS {table}_log_change ON content.{table};'
+        for table in TABLES
+    ] + [
+        'DROP FUNCTION IF EXISTS content.log_content_change();',
+        'DROP TABLE IF EXISTS content.change_log;',
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0009_content_change_notify'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=create_change_log_sql(),
+            reverse_sql=drop_change_log_sql(),
+        ),
+    ]
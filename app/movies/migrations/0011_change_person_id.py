@@ -0,0 +1,130 @@
+from django.db import migrations
+
+LOG_FUNCTION = """
+CREATE OR REPLACE FUNCTION content.log_content_change() RETURNS trigger AS $$
+DECLARE
+    row_data jsonb;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_data := to_jsonb(OLD);
+    ELSE
+        row_data := to_jsonb(NEW);
+    END IF;
+
+    INSERT INTO content.change_log (table_name, op, entity_id, film_work_id, person_id)
+    VALUES (
+        TG_TABLE_NAME,
+        TG_OP,
+        (row_data->>'id')::uuid,
+        CASE
+            WHEN TG_TABLE_NAME = 'film_work' THEN (row_data->>'id')::uuid
+            ELSE (row_data->>'film_work_id')::uuid
+        END,
+        CASE
+            WHEN TG_TABLE_NAME = 'person' THEN (row_data->>'id')::uuid
+            ELSE (row_data->>'person_id')::uuid
+        END
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+NOTIFY_FUNCTION = """
+CREATE OR REPLACE FUNCTION content.notify_content_change() RETURNS trigger AS $$
+DECLARE
+    row_data jsonb;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_data := to_jsonb(OLD);
+    ELSE
+        row_data := to_jsonb(NEW);
+    END IF;
+
+    PERFORM pg_notify(
+        'content_changed',
+        json_build_object(
+            'table', TG_TABLE_NAME,
+            'op', TG_OP,
+            'id', row_data->>'id',
+            'film_work_id', row_data->>'film_work_id',
+            'person_id', row_data->>'person_id'
+        )::text
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+OLD_LOG_FUNCTION = """
+CREATE OR REPLACE FUNCTION content.log_content_change() RETURNS trigger AS $$
+DECLARE
+    row_data jsonb;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_data := to_jsonb(OLD);
+    ELSE
+        row_data := to_jsonb(NEW);
+    END IF;
+
+    INSERT INTO content.change_log (table_name, op, entity_id, film_work_id)
+    VALUES (
+        TG_TABLE_NAME,
+        TG_OP,
+        (row_data->>'id')::uuid,
+        CASE
+            WHEN TG_TABLE_NAME = 'film_work' THEN (row_data->>'id')::uuid
+            ELSE (row_data->>'film_work_id')::uuid
+        END
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+OLD_NOTIFY_FUNCTION = """
+CREATE OR REPLACE FUNCTION content.notify_content_change() RETURNS trigger AS $$
+DECLARE
+    row_data jsonb;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_data := to_jsonb(OLD);
+    ELSE
+        row_data := to_jsonb(NEW);
+    END IF;
+
+    PERFORM pg_notify(
+        'content_changed',
+        json_build_object(
+            'table', TG_TABLE_NAME,
+            'op', TG_OP,
+            'id', row_data->>'id',
+            'film_work_id', row_data->>'film_work_id'
+        )::text
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0010_content_change_log'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[
+                'ALTER TABLE content.change_log ADD COLUMN IF NOT EXISTS person_id UUID;',
+                LOG_FUNCTION,
+                NOTIFY_FUNCTION,
+            ],
+            reverse_sql=[
+                OLD_NOTIFY_FUNCTION,
+                OLD_LOG_FUNCTION,
+                'ALTER TABLE content.change_log DROP COLUMN IF EXISTS person_id;',
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies', '0011_change_person_id'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=(
+                'CREATE INDEX IF NOT EXISTS change_log_txid_seq_idx '
+                'ON content.change_log (txid, seq);'
+            ),
+            reverse_sql='DROP INDEX IF EXISTS content.change_log_txid_seq_idx;',
+        ),
+    ]
@@ -34,6 +34,12 @@ class Genre(UUIDMixin, TimeStampedMixin):
         db_table = "content\".\"genre"
         verbose_name = _('Genre')
         verbose_name_plural = _('Genres')
+        indexes = [
+            models.Index(
+                fields=['modified', 'id'],
+                name='genre_modified_idx'
+            ),
+        ]
 
     def __str__(self):
         return self.name
@@ -92,6 +98,10 @@ class Filmwork(UUIDMixin, TimeStampedMixin):
                 fields=['creation_date'],
                 name='film_work_creation_date_idx'
             ),
+            models.Index(
+                fields=['modified', 'id'],
+                name='film_work_modified_idx'
+            ),
         ]
 
     def __str__(self):
@@ -142,6 +152,12 @@ class Person(UUIDMixin, TimeStampedMixin):
         db_table = "content\".\"person"
         verbose_name = _('Person')
         verbose_name_plural = _('Persons')
+        indexes = [
+            models.Index(
+                fields=['modified', 'id'],
+                name='person_modified_idx'
+            ),
+        ]
 
     def __str__(self):
         return self.full_name
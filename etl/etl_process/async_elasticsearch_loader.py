@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from elasticsearch import (AsyncElasticsearch, ConnectionError,
+                           SerializationError, TransportError)
+from elasticsearch.helpers import async_streaming_bulk
+from etl_utils import metrics
+from etl_utils.config import ESIndexConfig
+from etl_utils.dead_letter_storage import BaseDeadLetterStorage
+
+from .bulk_indexer import (BulkIndexer, BulkReport, estimate_payload_bytes,
+                           expand_raw_action)
+from .elasticsearch_loader import ElasticsearchLoader, dead_letter_records
+
+
+class AsyncElasticsearchLoader:
+    """
+    Асинхронная загрузка документов через async_streaming_bulk.
+    Как и ElasticsearchLoader, пишет в индекс по алиасу,
+    повторяет пачку после обрыва связи и сохраняет
+    незагруженные документы в dead letters
+    """
+    def __init__(
+        self,
+        dsn: str,
+        logger: logging.Logger,
+        maxsize: int = 10,
+        timeout: int = 30,
+        chunk_size: int = 500,
+        max_chunk_bytes: int = 10 * 1024 * 1024,
+        max_retries: int = 3,
+        initial_backoff: float = 1,
+        max_backoff: float = 30,
+        index_config: ESIndexConfig = None,
+        dead_letters: BaseDeadLetterStorage = None
+    ) -> None:
+        self.logger = logger
+        self.index_config = index_config or ESIndexConfig()
+        self.index_name = self.index_config.index_name
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.dead_letters = dead_letters
+        self.es = AsyncElasticsearch(
+            [dsn],
+            maxsize=maxsize,
+            timeout=timeout,
+            retry_on_timeout=True
+        )
+
+    async def close(self) -> None:
+        """Закрывает клиент Elasticsearch"""
+        await self.es.close()
+
+    async def create_index(self) -> None:
+        """
+        Создаёт первую версию индекса с алиасом, если индекса ещё нет,
+        ожидая готовности Elasticsearch. В существующий индекс
+        добавляются новые поля маппинга
+        """
+        sleep_time = 0.1
+        while not await self.es.ping():
+            self.logger.warning('Elasticsearch is not available, waiting %s seconds', sleep_time)
+            await asyncio.sleep(sleep_time)
+            sleep_time = min(sleep_time * 2, 10)
+
+        if not await self.es.indices.exists(index=self.index_name):
+            index = f'{self.index_name}_v1'
+            await self.es.indices.create(
+                index=index,
+                settings=self.index_config.settings,
+                mappings=self.index_config.mappings,
+                aliases={self.index_name: {}}
+            )
+            self.logger.info('Index %s created with alias %s', index, self.index_name)
+            return
+
+        properties = self.index_config.mappings['properties']
+        mappings = await self.es.indices.get_mapping(index=self.index_name)
+        for index, description in mappings.items():
+            current = description['mappings'].get('properties', {})
+            missing = {
+                name: field for name, field in properties.items()
+                if name not in current
+            }
+            if missing:
+                await self.es.indices.put_mapping(index=index, body={'properties': missing})
+                self.logger.info('Fields %s added to index %s', sorted(missing), index)
+
+    async def bulk(self, transformed_batch: list) -> BulkReport:
+        """
+        Загрузка пачки. Как и в BulkIndexer, хелпер запускается
+        без собственных повторов, документы с кодом 429 отправляются
+        заново с задержкой и учитываются в отчёте как повторно отправленные
+        Args:
+            transformed_batch: список bulk-действий
+        Returns:
+            поэлементный отчёт о загрузке
+        """
+        report = BulkReport()
+        actions = transformed_batch
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(
+                    min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1))
+                )
+                report.retried += len(actions)
+                self.logger.warning('Retrying %d rejected documents', len(actions))
+
+            by_id = {BulkIndexer.action_id(action): action for action in actions}
+            rejected = []
+            async for ok, item in async_streaming_bulk(
+                self.es,
+                actions,
+                chunk_size=self.chunk_size,
+                max_chunk_bytes=self.max_chunk_bytes,
+                max_retries=0,
+                expand_action_callback=expand_raw_action,
+                raise_on_error=False,
+                index=self.index_name
+            ):
+                info = next(iter(item.values()))
+                if not ok and info.get('status') == 429 and attempt < self.max_retries:
+                    rejected.append(by_id[str(info.get('_id'))])
+                else:
+                    report.add(ok, item)
+
+            if not rejected:
+                break
+            actions = rejected
+
+        return report
+
+    async def load(
+        self,
+        transformed_batch: list,
+        checkpoint: Optional[dict] = None
+    ) -> BulkReport:
+        """
+        Загрузка данных в Elasticsearch.
+        Временные ошибки повторяются для этой же пачки,
+        ошибки документов и неисправимые ошибки запроса
+        сохраняются в dead letters
+        Args:
+            transformed_batch: список bulk-действий
+            checkpoint: словарь состояний пачки для записи в dead letters
+        Returns:
+            поэлементный отчёт о загрузке
+        """
+        sleep_time = 0.1
+        while True:
+            started = time.monotonic()
+            try:
+                report = await self.bulk(transformed_batch)
+                break
+            except (SerializationError, TransportError) as error:
+                if not isinstance(error, ConnectionError) \
+                        and ElasticsearchLoader.is_permanent_error(error):
+                    self.logger.error('Bulk request rejected: %s', error)
+                    report = ElasticsearchLoader.reject_batch(transformed_batch, error)
+                    break
+                self.logger.exception('Error occurred. Trying again...')
+                self.logger.info('Waiting %s seconds...', sleep_time)
+                metrics.RETRIES.labels(self.index_name, 'load').inc()
+                await asyncio.sleep(sleep_time)
+                sleep_time = min(sleep_time * 2, 10)
+
+        metrics.observe_stage(
+            self.index_name, 'load', len(transformed_batch), time.monotonic() - started
+        )
+        metrics.BYTES.labels(self.index_name).inc(estimate_payload_bytes(transformed_batch))
+        metrics.DOCUMENTS_RETRIED.labels(self.index_name).inc(report.retried)
+        metrics.FAILED.labels(self.index_name).inc(len(report.failed))
+        self.logger.info('Bulk into %s finished: %s', self.index_name, report)
+        for failure in report.failed:
+            self.logger.error(
+                'Document %s was not indexed: %s %s',
+                failure['_id'], failure['status'], failure['error']
+            )
+        if report.failed and self.dead_letters is not None:
+            letters = dead_letter_records(self.index_name, transformed_batch, report, checkpoint)
+            await asyncio.to_thread(self.dead_letters.save_letters, letters)
+        return report
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+
+from etl_utils import metrics
+from etl_utils.state_storage import State
+
+from .async_elasticsearch_loader import AsyncElasticsearchLoader
+from .async_postgres_extractor import AsyncPostgresExtractor
+from .transformer import Transformer
+
+_DONE = object()
+
+
+class AsyncPipeline:
+    """
+    Асинхронный конвейер одного индекса: извлечение и загрузка
+    выполняются одновременно в задачах одного event loop,
+    связанных ограниченной очередью. Трансформация выполняется
+    на стороне извлечения, загрузка идёт по порядку, поэтому
+    состояние сохраняется только после загрузки всех предыдущих пачек
+    """
+    def __init__(
+        self,
+        extractor: AsyncPostgresExtractor,
+        transformer: Transformer,
+        loader: AsyncElasticsearchLoader,
+        state: State,
+        logger: logging.Logger,
+        queue_size: int = 4
+    ) -> None:
+        self.extractor = extractor
+        self.transformer = transformer
+        self.loader = loader
+        self.state = state
+        self.logger = logger
+        self.queue_size = queue_size
+
+    async def run(self) -> None:
+        """
+        Запустить конвейер и дождаться его завершения.
+        Ошибка в одной из задач отменяет другую и пробрасывается
+        """
+        output = asyncio.Queue(maxsize=self.queue_size)
+        tasks = [
+            asyncio.create_task(self._extract(output)),
+            asyncio.create_task(self._load(output)),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def _extract(self, output: asyncio.Queue) -> None:
+        index = self.loader.index_name
+        i = 0
+        batches = metrics.track_async_batches(index, self.extractor, self.extractor.extract())
+        async for batch, checkpoint in batches:
+            i += 1
+            self.logger.info('Extracted %d %s batch', i, index)
+            started = time.monotonic()
+            transformed_batch = self.transformer.transform(batch)
+            metrics.observe_stage(index, 'transform', len(batch), time.monotonic() - started)
+            await output.put((i, transformed_batch, checkpoint))
+            metrics.observe_queues(index, {'load': output})
+        await output.put(_DONE)
+
+    async def _load(self, source: asyncio.Queue) -> None:
+        while (item := await source.get()) is not _DONE:
+            i, transformed_batch, checkpoint = item
+            if transformed_batch:
+                await self.loader.load(transformed_batch, checkpoint)
+            self.logger.info('Loaded %d %s batch', i, self.loader.index_name)
+            await asyncio.to_thread(self.state.commit, checkpoint)
+            metrics.observe_checkpoint(self.loader.index_name, checkpoint)
+            metrics.observe_queues(self.loader.index_name, {'load': source})
+        metrics.observe_pending(self.loader.index_name, await self.extractor.oldest_pending())
+
+
+async def run_async_pipelines(pipelines: list[AsyncPipeline], logger: logging.Logger) -> None:
+    """
+    Один проход ETL по всем индексам на одном event loop.
+    Ошибка одного индекса не останавливает остальные,
+    следующий проход продолжит его с последней сохранённой пачки
+    Args:
+        pipelines: конвейеры индексов
+        logger: логгер
+    """
+    results = await asyncio.gather(
+        *(pipeline.run() for pipeline in pipelines),
+        return_exceptions=True
+    )
+    for pipeline, result in zip(pipelines, results):
+        if isinstance(result, Exception):
+            logger.error(
+                'ETL process of %s failed, next run resumes from the last saved batch',
+                pipeline.loader.index_name,
+                exc_info=result
+            )
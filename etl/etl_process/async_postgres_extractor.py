@@ -0,0 +1,252 @@
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import Any, AsyncIterator, Optional
+
+import asyncpg
+from etl_utils import metrics
+from etl_utils.state_storage import State
+
+from .postgres_extractor import DEFAULT_WATERMARK
+from .queries import (ASYNC_PENDING_QUERY, ASYNC_PRODUCER_QUERY, MOVIES_QUERIES,
+                      ExtractionQueries)
+
+# Ошибки, после которых извлечение продолжается на новом подключении
+CONNECTION_ERRORS = (asyncpg.PostgresConnectionError, asyncpg.InterfaceError, OSError)
+
+
+def positional(query: str) -> str:
+    """
+    Переводит запрос с единственным параметром-массивом id
+    из формата psycopg2 в формат asyncpg
+    Args:
+        query: запрос с параметром %s::uuid[]
+    Returns:
+        запрос с параметром $1
+    """
+    return query.replace('%s::uuid[]', '$1::text[]::uuid[]')
+
+
+async def init_connection(conn: asyncpg.Connection) -> None:
+    """Разбирает json и jsonb в объекты Python, как это делает psycopg2"""
+    for type_name in ('json', 'jsonb'):
+        await conn.set_type_codec(
+            type_name,
+            encoder=json.dumps,
+            decoder=json.loads,
+            schema='pg_catalog'
+        )
+
+
+async def create_pool(dsn: dict, max_size: int = 5) -> asyncpg.Pool:
+    """
+    Создаёт пул подключений asyncpg
+    Args:
+        dsn: словарь с параметрами подключения
+        max_size: размер пула
+    Returns:
+        пул подключений
+    """
+    return await asyncpg.create_pool(
+        host=dsn['host'],
+        port=int(dsn['port']),
+        user=dsn['user'],
+        password=dsn['password'],
+        database=dsn['dbname'],
+        min_size=1,
+        max_size=max_size,
+        init=init_connection
+    )
+
+
+class AsyncPostgresExtractor:
+    """
+    Асинхронный вариант PostgresExtractor на asyncpg.
+    Изменения читаются потоковым курсором по watermark'ам на modified,
+    стадии producer -> enricher -> merger те же
+    """
+    def __init__(
+        self,
+        pool: asyncpg.Pool,
+        batch_size: int,
+        state: State,
+        logger: logging.Logger,
+        itersize: int = 1000,
+        raw_documents: bool = False,
+        queries: ExtractionQueries = MOVIES_QUERIES,
+        index_name: str = 'movies'
+    ) -> None:
+        self.pool = pool
+        self.batch_size = batch_size
+        self.state = state
+        self.logger = logger
+        self.itersize = itersize
+        self.queries = queries
+        # имя индекса для метрик
+        self.index_name = index_name
+        self.raw_documents = raw_documents and queries.document_merger is not None
+        self.progress = {}
+
+    def state_key(self, key: str) -> str:
+        """Ключ состояния индекса"""
+        return self.queries.state_prefix + key
+
+    def position(self, key: str) -> Any:
+        """
+        Позиция извлечения по ключу состояния: последняя выданная
+        в этом проходе или сохранённая в State
+        """
+        if key in self.progress:
+            return self.progress[key]
+        return self.state.get_state(key)
+
+    async def oldest_pending(self) -> Optional[datetime]:
+        """
+        Время самого старого изменения после сохранённых watermark'ов
+        Returns:
+            время изменения или None, если всё загружено
+        """
+        oldest = []
+        async with self.pool.acquire() as conn:
+            for table in self.queries.enrichers:
+                watermark = self.state.get_state(self.state_key(f'{table}_watermark'))
+                watermark = watermark or DEFAULT_WATERMARK
+                modified = await conn.fetchval(
+                    ASYNC_PENDING_QUERY.format(table=table, partition=''),
+                    watermark['modified'],
+                    watermark['id']
+                )
+                if modified is not None:
+                    oldest.append(modified)
+        return min(oldest, default=None)
+
+    async def extract(self) -> AsyncIterator[tuple[list, dict]]:
+        """
+        Извлекает изменённые документы индекса из Postgres.
+        После обрыва связи извлечение продолжается с пачки,
+        на которой оборвалось
+        Yields:
+            Пачка записей из Postgres и словарь состояний,
+            который нужно сохранить после загрузки пачки
+        """
+        self.progress = {}
+        sleep_time = 0.1
+        while True:
+            try:
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction(readonly=True):
+                        for table in self.queries.enrichers:
+                            async for item in self.extract_table(conn, table):
+                                yield item
+                return
+            except CONNECTION_ERRORS:
+                self.logger.exception('Postgres connection lost, resuming extraction')
+                self.logger.info('Waiting %s seconds...', sleep_time)
+                metrics.RETRIES.labels(self.index_name, 'extract').inc()
+                await asyncio.sleep(sleep_time)
+                sleep_time = min(sleep_time * 2, 10)
+
+    async def extract_table(self, conn, table: str) -> AsyncIterator[tuple[list, dict]]:
+        """
+        Прогоняет изменения одной таблицы через стадии
+        producer -> enricher -> merger
+        Args:
+            conn: подключение asyncpg в открытой транзакции
+            table: имя таблицы в схеме content
+        Yields:
+            Пачка записей из Postgres и словарь состояний
+        """
+        state_key = self.state_key(f'{table}_watermark')
+        watermark = self.position(state_key) or DEFAULT_WATERMARK
+        self.logger.info('Extracting %s after watermark %s', table, watermark)
+
+        producer = conn.cursor(
+            ASYNC_PRODUCER_QUERY.format(table=table, partition=''),
+            watermark['modified'],
+            watermark['id'],
+            prefetch=self.itersize
+        )
+        changed = []
+        async for row in producer:
+            changed.append(row)
+            if len(changed) < self.batch_size:
+                continue
+            async for item in self.process(conn, table, state_key, changed):
+                yield item
+            changed = []
+        if changed:
+            async for item in self.process(conn, table, state_key, changed):
+                yield item
+
+    async def process(
+        self,
+        conn,
+        table: str,
+        state_key: str,
+        changed: list
+    ) -> AsyncIterator[tuple[list, dict]]:
+        """
+        Обогащает и собирает документы по пачке изменённых записей
+        Args:
+            conn: подключение asyncpg
+            table: имя таблицы в схеме content
+            state_key: ключ watermark'а таблицы
+            changed: изменённые записи таблицы
+        Yields:
+            Пачка записей из Postgres и словарь состояний
+        """
+        self.logger.info('Produced %d changed %s rows', len(changed), table)
+        ids = await self.enrich(conn, table, [str(row['id']) for row in changed])
+        checkpoint = {
+            state_key: {
+                'modified': changed[-1]['modified'].isoformat(),
+                'id': str(changed[-1]['id'])
+            }
+        }
+
+        chunks = [
+            ids[i:i + self.batch_size]
+            for i in range(0, len(ids), self.batch_size)
+        ] or [[]]
+        for i, chunk in enumerate(chunks, start=1):
+            batch = await self.merge(conn, chunk)
+            self.logger.info('Extracted %d rows from Postgres', len(batch))
+            if i < len(chunks):
+                yield batch, {}
+                continue
+            self.progress.update(checkpoint)
+            yield batch, checkpoint
+
+    async def enrich(self, conn, table: str, ids: list[str]) -> list[str]:
+        """
+        Находит id документов, затронутых изменёнными записями
+        Args:
+            conn: подключение asyncpg
+            table: имя таблицы, в которой найдены изменения
+            ids: id изменённых записей
+        Returns:
+            список id документов
+        """
+        query = self.queries.enrichers[table]
+        if query is None:
+            return ids
+        rows = await conn.fetch(positional(query), ids)
+        return [str(row[0]) for row in rows]
+
+    async def merge(self, conn, ids: list[str]) -> list:
+        """
+        Собирает полные данные по документам.
+        В режиме raw_documents возвращает пары (id, json документа)
+        Args:
+            conn: подключение asyncpg
+            ids: id документов
+        Returns:
+            список записей из Postgres
+        """
+        if not ids:
+            return []
+        if self.raw_documents:
+            rows = await conn.fetch(positional(self.queries.document_merger), ids)
+            return [(str(row[0]), row[1]) for row in rows]
+        return await conn.fetch(positional(self.queries.merger), ids)
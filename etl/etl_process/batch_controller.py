@@ -0,0 +1,77 @@
+import logging
+import threading
+
+
+class BatchSizeController:
+    """
+    Подбор размера пачки по принципу AIMD: пока Elasticsearch
+    укладывается в целевые задержку и объём запроса, размер растёт
+    на постоянный шаг, а при отказах 429 или медленном ответе
+    уменьшается в разы. Так ETL занимает свободную мощность кластера
+    и быстро уступает её поисковым запросам
+    """
+    def __init__(
+        self,
+        logger: logging.Logger,
+        initial: int = 100,
+        min_size: int = 50,
+        max_size: int = 5000,
+        target_latency: float = 1.0,
+        target_bytes: int = 5 * 1024 * 1024,
+        increase_step: int = 100,
+        decrease_factor: float = 0.5
+    ) -> None:
+        self.logger = logger
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.target_bytes = target_bytes
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.size = min(max(initial, min_size), max_size)
+        self.lock = threading.Lock()
+
+    def observe(
+        self,
+        documents: int,
+        latency: float,
+        rejected: int,
+        payload_bytes: int
+    ) -> int:
+        """
+        Пересчитывает размер пачки по результату bulk-загрузки
+        Args:
+            documents: число отправленных документов
+            latency: время загрузки пачки в секундах
+            rejected: число документов, отклонённых с кодом 429
+            payload_bytes: объём отправленных документов в байтах
+        Returns:
+            новый размер пачки
+        """
+        if not documents:
+            return self.size
+
+        with self.lock:
+            size = self.size
+            if rejected:
+                size = int(size * self.decrease_factor)
+                reason = f'{rejected} rejected documents'
+            elif latency > self.target_latency:
+                size = int(size * self.decrease_factor)
+                reason = f'bulk latency {latency:.2f}s'
+            elif payload_bytes / documents * (size + self.increase_step) > self.target_bytes:
+                # не растём дальше объёма, который укладывается в target_bytes
+                size = int(self.target_bytes * documents / payload_bytes)
+                reason = f'payload {payload_bytes} bytes for {documents} documents'
+            elif documents * 2 >= size:
+                size += self.increase_step
+                reason = f'bulk latency {latency:.2f}s'
+            else:
+                # почти пустая пачка ничего не говорит о запасе мощности
+                return self.size
+
+            size = min(max(size, self.min_size), self.max_size)
+            if size != self.size:
+                self.logger.info('Batch size %d -> %d: %s', self.size, size, reason)
+                self.size = size
+            return self.size
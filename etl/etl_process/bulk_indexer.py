@@ -0,0 +1,189 @@
+import json
+import logging
+import time
+from typing import Iterator
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import expand_action, parallel_bulk, streaming_bulk
+
+
+def expand_raw_action(action) -> tuple:
+    """
+    Разбирает bulk-действие на заголовок и тело.
+    Готовые пары (заголовок, json-строка) передаются как есть:
+    сериализатор клиента не трогает строки, поэтому тело
+    попадает в NDJSON без повторного кодирования
+    """
+    if isinstance(action, tuple):
+        return action
+    return expand_action(action)
+
+
+def estimate_payload_bytes(actions: list, sample: int = 20) -> int:
+    """
+    Оценивает объём тел bulk-действий по равномерной выборке,
+    чтобы не сериализовать всю пачку второй раз
+    Args:
+        actions: список bulk-действий
+        sample: размер выборки
+    Returns:
+        оценка объёма в байтах
+    """
+    if not actions:
+        return 0
+    step = max(1, len(actions) // sample)
+    sampled = actions[::step]
+    total = 0
+    for action in sampled:
+        _, body = expand_raw_action(action)
+        if body is None:
+            continue
+        if not isinstance(body, str):
+            body = json.dumps(body, ensure_ascii=False, default=str)
+        total += len(body.encode('utf-8'))
+    return total * len(actions) // len(sampled)
+
+
+class BulkReport:
+    """Поэлементный результат bulk-загрузки"""
+    def __init__(self) -> None:
+        self.ok = 0
+        self.retried = 0
+        self.failed = []
+
+    def add(self, ok: bool, item: dict) -> None:
+        """
+        Учитывает результат одного документа
+        Args:
+            ok: успешно ли проиндексирован документ
+            item: ответ Elasticsearch по документу
+        """
+        op_type, info = next(iter(item.items()))
+        if ok or (op_type == 'delete' and info.get('status') == 404):
+            self.ok += 1
+            return
+
+        self.failed.append({
+            'op_type': op_type,
+            '_id': info.get('_id'),
+            'status': info.get('status'),
+            'error': info.get('error') or info.get('exception')
+        })
+
+    @property
+    def rejected(self) -> int:
+        """Число отказов с кодом 429, включая повторно отправленные документы"""
+        return self.retried + sum(1 for failure in self.failed if failure['status'] == 429)
+
+    def __str__(self) -> str:
+        return f'ok: {self.ok}, failed: {len(self.failed)}, retried: {self.retried}'
+
+
+class BulkIndexer:
+    """
+    Загрузка документов через streaming_bulk или parallel_bulk.
+    Ошибка отдельного документа не прерывает загрузку пачки,
+    повторно отправляются только документы, отклонённые с кодом 429
+    """
+    def __init__(
+        self,
+        logger: logging.Logger,
+        thread_count: int = 1,
+        chunk_size: int = 500,
+        max_chunk_bytes: int = 10 * 1024 * 1024,
+        max_retries: int = 3,
+        initial_backoff: float = 1,
+        max_backoff: float = 30
+    ) -> None:
+        self.logger = logger
+        self.thread_count = thread_count
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+
+    def index(
+        self,
+        client: Elasticsearch,
+        actions: list,
+        index: str = None,
+        expand_action_callback=expand_raw_action,
+        chunk_size: int = None
+    ) -> BulkReport:
+        """
+        Загружает документы в Elasticsearch.
+        Хелперы запускаются без собственных повторов, документы
+        с кодом 429 отправляются заново с задержкой и учитываются
+        в отчёте как повторно отправленные
+        Args:
+            client: клиент Elasticsearch
+            actions: список bulk-действий
+            index: индекс для действий без _index
+            expand_action_callback: функция разбора действия на заголовок и тело
+            chunk_size: число документов в bulk-запросе вместо настроенного
+        Returns:
+            поэлементный отчёт о загрузке
+        """
+        report = BulkReport()
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1)))
+                report.retried += len(actions)
+                self.logger.warning('Retrying %d rejected documents', len(actions))
+
+            by_id = {self.action_id(action, expand_action_callback): action for action in actions}
+            rejected = []
+            for ok, item in self.bulk(
+                client, actions, index, expand_action_callback, chunk_size
+            ):
+                info = next(iter(item.values()))
+                if not ok and info.get('status') == 429 and attempt < self.max_retries:
+                    rejected.append(by_id[str(info.get('_id'))])
+                else:
+                    report.add(ok, item)
+
+            if not rejected:
+                break
+            actions = rejected
+
+        return report
+
+    @staticmethod
+    def action_id(action, expand_action_callback=expand_raw_action) -> str:
+        """Возвращает _id документа из bulk-действия"""
+        header, _ = expand_action_callback(action)
+        return str(next(iter(header.values())).get('_id'))
+
+    def bulk(
+        self,
+        client: Elasticsearch,
+        actions: list,
+        index: str = None,
+        expand_action_callback=expand_raw_action,
+        chunk_size: int = None
+    ) -> Iterator[tuple[bool, dict]]:
+        """
+        Один проход загрузки через streaming_bulk или, при нескольких
+        потоках, через parallel_bulk. Отклонённые документы
+        не повторяются, чтобы повторы видел index
+        Args:
+            client: клиент Elasticsearch
+            actions: список bulk-действий
+            index: индекс для действий без _index
+            expand_action_callback: функция разбора действия на заголовок и тело
+            chunk_size: число документов в bulk-запросе вместо настроенного
+        Returns:
+            итератор успешности и ответа Elasticsearch по каждому документу
+        """
+        options = dict(
+            chunk_size=chunk_size or self.chunk_size,
+            max_chunk_bytes=self.max_chunk_bytes,
+            expand_action_callback=expand_action_callback,
+            raise_on_error=False,
+            index=index
+        )
+        if self.thread_count > 1:
+            return parallel_bulk(client, actions, thread_count=self.thread_count, **options)
+        return streaming_bulk(client, actions, max_retries=0, **options)
@@ -0,0 +1,169 @@
+import json
+import logging
+import select
+import time
+from datetime import timedelta
+from typing import Optional
+
+import psycopg2
+import psycopg2.extensions
+from etl_utils.backoff import backoff
+
+# Таблицы, изменения которых не видны по watermark'ам на modified,
+# поэтому id их фильмов и персон передаются в извлечение явно
+LINK_TABLES = ('genre_film_work', 'person_film_work')
+
+# Поля уведомлений с id документов, изменённых через связи
+LINK_KEYS = ('film_work_id', 'person_id')
+
+# Связи, созданные, пока подключение было потеряно. created - время начала
+# транзакции, поэтому окно расширяется на CATCH_UP_MARGIN для транзакций,
+# начатых до обрыва. Удаления связей так не найти, их видит журнал изменений
+CATCH_UP_QUERY = """
+    SELECT film_work_id::text, NULL
+    FROM content.genre_film_work
+    WHERE created >= %(since)s
+    UNION ALL
+    SELECT film_work_id::text, person_id::text
+    FROM content.person_film_work
+    WHERE created >= %(since)s
+"""
+
+CATCH_UP_MARGIN = timedelta(minutes=1)
+
+
+class ChangeListener:
+    """
+    Слушает уведомления Postgres (LISTEN/NOTIFY) об изменениях
+    в таблицах content и собирает их в микропачки.
+    Уведомления, отправленные без подключения, теряются, поэтому
+    после переподключения связи, созданные за это время, дочитываются
+    из таблиц и сразу отдаются на догоняющий проход
+    """
+    def __init__(
+        self,
+        dsn: dict,
+        logger: logging.Logger,
+        channel: str = 'content_changed',
+        debounce: float = 0.5,
+        max_delay: float = 2.0
+    ) -> None:
+        self.dsn = dsn
+        self.logger = logger
+        self.channel = channel
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.conn = None
+        # время Postgres и monotonic в момент подписки
+        self.clock = None
+        # monotonic последней успешной проверки подключения
+        self.alive = None
+        # изменения, дочитанные после переподключения
+        self.missed = None
+
+    @backoff()
+    def connect(self) -> None:
+        """
+        Открывает подключение в режиме autocommit и подписывается на канал.
+        После обрыва дочитывает связи, созданные с последней проверки
+        прошлого подключения
+        """
+        self.conn = psycopg2.connect(**self.dsn)
+        self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with self.conn.cursor() as cursor:
+            cursor.execute(f'LISTEN {self.channel};')
+            cursor.execute('SELECT now();')
+            clock = (cursor.fetchone()[0], time.monotonic())
+
+            if self.clock is not None:
+                since = self.clock[0] + timedelta(seconds=self.alive - self.clock[1])
+                cursor.execute(CATCH_UP_QUERY, {'since': since - CATCH_UP_MARGIN})
+                missed = {key: set() for key in LINK_KEYS}
+                for film_id, person_id in cursor.fetchall():
+                    missed['film_work_id'].add(film_id)
+                    if person_id:
+                        missed['person_id'].add(person_id)
+                self.missed = missed
+                self.logger.info(
+                    'Caught up %d films and %d persons from links since %s',
+                    len(missed['film_work_id']), len(missed['person_id']), since
+                )
+        self.clock = clock
+        self.alive = clock[1]
+        self.logger.info('Listening to %s notifications', self.channel)
+
+    def close(self) -> None:
+        """Закрывает подключение"""
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+        self.conn = None
+
+    def _ready(self, timeout: float) -> bool:
+        """Ждёт данных на сокете подключения не дольше timeout секунд"""
+        return select.select([self.conn], [], [], max(timeout, 0)) != ([], [], [])
+
+    def _drain(self, changes: dict) -> int:
+        """
+        Забирает пришедшие уведомления
+        Args:
+            changes: множества id документов из связей по полям LINK_KEYS
+        Returns:
+            количество уведомлений
+        """
+        self.conn.poll()
+        count = len(self.conn.notifies)
+        for notify in self.conn.notifies:
+            try:
+                payload = json.loads(notify.payload)
+            except ValueError:
+                continue
+            if payload.get('table') not in LINK_TABLES:
+                continue
+            for key in LINK_KEYS:
+                if payload.get(key):
+                    changes[key].add(payload[key])
+        self.conn.notifies.clear()
+        return count
+
+    def wait(self, timeout: float) -> Optional[dict]:
+        """
+        Ждёт изменений не дольше timeout секунд.
+        После первого уведомления продолжает собирать следующие,
+        пока они приходят чаще debounce, но не дольше max_delay
+        Args:
+            timeout: время ожидания, после которого выполняется плановый проход
+        Returns:
+            id документов из изменённых связей по полям LINK_KEYS
+            (film_work_id, person_id) или None, если изменений не было.
+            После потери подключения возвращаются сразу,
+            чтобы пропущенное загрузил догоняющий проход
+        """
+        if self.conn is None or self.conn.closed:
+            self.connect()
+        if self.missed is not None:
+            missed, self.missed = self.missed, None
+            return missed
+
+        changes = {key: set() for key in LINK_KEYS}
+        try:
+            if not self._ready(timeout):
+                self.alive = time.monotonic()
+                return None
+
+            count = self._drain(changes)
+            deadline = time.monotonic() + self.max_delay
+            while self._ready(min(self.debounce, deadline - time.monotonic())):
+                count += self._drain(changes)
+                if time.monotonic() >= deadline:
+                    break
+            self.alive = time.monotonic()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.logger.exception('Notification connection lost')
+            self.close()
+            return changes
+
+        self.logger.info(
+            'Received %d notifications, %d films and %d persons from links',
+            count, len(changes['film_work_id']), len(changes['person_id'])
+        )
+        return changes
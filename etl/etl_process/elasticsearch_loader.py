@@ -1,44 +1,461 @@
+import json
 import logging
+import time
+from datetime import datetime, timezone
+from typing import Optional
 
-from elasticsearch.helpers import bulk
+from elasticsearch import ConnectionError, SerializationError, TransportError
+from etl_utils import metrics
 from etl_utils.backoff import backoff
-from etl_utils.config import ETLServicesConfig
-from etl_utils.connection_config import es_connection
+from etl_utils.config import ESIndexConfig
+from etl_utils.connection_config import create_es_client
+from etl_utils.dead_letter_storage import BaseDeadLetterStorage
+from etl_utils.digest_storage import BaseDigestStorage, document_digest
+
+from .batch_controller import BatchSizeController
+from .bulk_indexer import (BulkIndexer, BulkReport, estimate_payload_bytes,
+                           expand_raw_action)
+
+
+def dead_letter_records(
+    index_name: str,
+    transformed_batch: list,
+    report: BulkReport,
+    checkpoint: Optional[dict]
+) -> list[dict]:
+    """
+    Записи о незагруженных документах для хранилища dead letters
+    Args:
+        index_name: имя индекса
+        transformed_batch: список bulk-действий
+        report: отчёт о загрузке
+        checkpoint: словарь состояний пачки
+    Returns:
+        записи с заголовком и телом действия, ошибкой и watermark'ом
+    """
+    actions = {}
+    for action in transformed_batch:
+        header, source = expand_raw_action(action)
+        actions[str(next(iter(header.values())).get('_id'))] = (header, source)
+
+    failed_at = datetime.now(timezone.utc).isoformat()
+    letters = []
+    for failure in report.failed:
+        header, source = actions.get(
+            str(failure['_id']),
+            ({failure['op_type']: {'_id': failure['_id']}}, None)
+        )
+        if source is not None and not isinstance(source, str):
+            source = json.dumps(source, ensure_ascii=False, default=str)
+        error = failure['error']
+        if not isinstance(error, str):
+            error = json.dumps(error, ensure_ascii=False, default=str)
+        letters.append({
+            'index': index_name,
+            'doc_id': str(failure['_id']),
+            'op_type': failure['op_type'],
+            'header': header,
+            'source': source,
+            'status': str(failure['status']),
+            'error': error,
+            'watermark': checkpoint or {},
+            'failed_at': failed_at
+        })
+    return letters
 
 
 class ElasticsearchLoader:
-    def __init__(self, dsn: dict, logger: logging.Logger) -> None:
+    def __init__(
+        self,
+        dsn: dict,
+        logger: logging.Logger,
+        maxsize: int = 10,
+        timeout: int = 30,
+        indexer: BulkIndexer = None,
+        index_config: ESIndexConfig = None,
+        digests: BaseDigestStorage = None,
+        batch_controller: BatchSizeController = None,
+        dead_letters: BaseDeadLetterStorage = None
+    ) -> None:
         self.dsn = dsn
         self.logger = logger
+        self.index_config = index_config or ESIndexConfig()
+        self.index_name = self.index_config.index_name
+        self.write_index = self.index_name
+        self.indexer = indexer or BulkIndexer(logger)
+        self.digests = digests
+        self.batch_controller = batch_controller
+        self.dead_letters = dead_letters
+        self.skip_unchanged = True
+        self.writes_avoided = 0
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.client = None
         self.create_index()
 
+    @property
+    def es(self):
+        """
+        Долгоживущий клиент Elasticsearch,
+        создаётся при первом обращении и после обрыва связи
+        """
+        if self.client is None:
+            self.client = create_es_client(self.dsn, self.maxsize, self.timeout)
+        return self.client
+
+    def close(self) -> None:
+        """Закрывает клиент Elasticsearch"""
+        if self.client is not None:
+            self.client.close()
+        self.client = None
+
+    def on_connection_error(self) -> None:
+        """
+        Проверяет доступность Elasticsearch после ошибки соединения
+        и сбрасывает клиент, чтобы следующая попытка открыла новые соединения
+        """
+        try:
+            available = self.es.ping()
+        except Exception:
+            available = False
+        self.logger.warning('Elasticsearch connection failed, ping: %s', available)
+        self.close()
+
     @backoff()
     def create_index(self):
-        with es_connection(self.dsn) as es:
-            if not es.ping():
-                raise Exception(
-                    'Elasticsearch is not available, '
-                    'maybe it is still starting up?'
-                )
+        """
+        Создаёт первую версию индекса с алиасом, если индекса ещё нет.
+        Индекс без версии из прежних запусков остаётся как есть
+        и заменяется алиасом при первой переиндексации
+        """
+        if not self.es.ping():
+            self.close()
+            raise Exception(
+                'Elasticsearch is not available, '
+                'maybe it is still starting up?'
+            )
 
-            if not es.indices.exists(index='movies'):
-                es.indices.create(
-                    index=ETLServicesConfig().index_config.index_name,
-                    settings=ETLServicesConfig().index_config.settings,
-                    mappings=ETLServicesConfig().index_config.mappings
-                )
-                self.logger.info('Index movies created')
+        if not self.es.indices.exists(index=self.index_name):
+            index = f'{self.index_name}_v1'
+            self.es.indices.create(
+                index=index,
+                settings=self.index_config.settings,
+                mappings=self.index_config.mappings,
+                aliases={self.index_name: {}}
+            )
+            self.logger.info('Index %s created with alias %s', index, self.index_name)
+        else:
+            self.add_missing_fields()
+
+    def add_missing_fields(self) -> None:
+        """
+        Добавляет в маппинг существующего индекса поля,
+        которые появились в конфигурации индекса позже.
+        Новые поля не требуют переиндексации
+        """
+        properties = self.index_config.mappings['properties']
+        for index, description in self.es.indices.get_mapping(index=self.index_name).items():
+            current = description['mappings'].get('properties', {})
+            missing = {
+                name: field for name, field in properties.items()
+                if name not in current
+            }
+            if missing:
+                self.es.indices.put_mapping(index=index, body={'properties': missing})
+                self.logger.info('Fields %s added to index %s', sorted(missing), index)
+
+    def versions(self) -> dict:
+        """
+        Возвращает версионные индексы и их алиасы
+        Returns:
+            словарь имя индекса -> описание алиасов
+        """
+        return self.es.indices.get_alias(index=f'{self.index_name}_v*')
 
     @backoff()
-    def load(self, transformed_batch: list[dict]):
+    def start_reindex(self) -> str:
         """
-        Загрузка данных в Elasticsearch
+        Создаёт новую версию индекса с настройками для массовой загрузки:
+        без обновлений и реплик. Загрузка дальше идёт в неё,
+        поиск по алиасу продолжает работать со старой версией
+        Returns:
+            имя новой версии индекса
+        """
+        versions = self.versions()
+        for index, description in versions.items():
+            if self.index_name not in description.get('aliases', {}):
+                self.es.indices.delete(index=index)
+                self.logger.info('Stale index %s deleted', index)
+
+        number = max(
+            (int(index.rsplit('_v', 1)[1]) for index in versions),
+            default=0
+        ) + 1
+        index = f'{self.index_name}_v{number}'
+        settings = dict(self.index_config.settings)
+        settings.update({'refresh_interval': '-1', 'number_of_replicas': 0})
+        self.es.indices.create(
+            index=index,
+            settings=settings,
+            mappings=self.index_config.mappings
+        )
+        self.write_index = index
+        self.skip_unchanged = False
+        self.logger.info('Reindex into %s started', index)
+        return index
+
+    @backoff()
+    def finish_reindex(self) -> None:
+        """
+        Возвращает новой версии индекса рабочие настройки,
+        сливает сегменты и атомарно переключает на неё алиас.
+        Старые версии индекса удаляются
+        """
+        index = self.write_index
+        old_indices = []
+        if self.es.indices.exists_alias(name=self.index_name):
+            old_indices = list(self.es.indices.get_alias(name=self.index_name))
+        replicas = '1'
+        if old_indices:
+            replicas = self.es.indices.get_settings(
+                index=old_indices[0],
+                name='index.number_of_replicas'
+            )[old_indices[0]]['settings']['index']['number_of_replicas']
+
+        self.es.indices.put_settings(
+            index=index,
+            body={
+                'refresh_interval': self.index_config.settings['refresh_interval'],
+                'number_of_replicas': replicas
+            }
+        )
+        self.es.indices.refresh(index=index)
+        self.es.indices.forcemerge(
+            index=index,
+            max_num_segments=1,
+            request_timeout=3600
+        )
+
+        actions = [{'add': {'index': index, 'alias': self.index_name}}]
+        if self.es.indices.exists(index=self.index_name) and not old_indices:
+            # индекс без версии из прежних запусков занимает имя алиаса
+            actions.insert(0, {'remove_index': {'index': self.index_name}})
+        actions[:0] = [
+            {'remove': {'index': old, 'alias': self.index_name}}
+            for old in old_indices
+        ]
+        self.es.indices.update_aliases(body={'actions': actions})
+        self.logger.info('Alias %s switched to %s', self.index_name, index)
+
+        for old in old_indices:
+            self.es.indices.delete(index=old)
+            self.logger.info('Old index %s deleted', old)
+        self.write_index = self.index_name
+        self.skip_unchanged = True
+
+    @staticmethod
+    def action_digest(action) -> tuple[str, str, Optional[str]]:
+        """
+        Разбирает bulk-действие для сравнения хэшей
+        Returns:
+            тип операции, id документа и хэш _source (None для удаления)
+        """
+        header, source = expand_raw_action(action)
+        op_type, meta = next(iter(header.items()))
+        if op_type == 'delete':
+            return op_type, str(meta['_id']), None
+        return op_type, str(meta['_id']), document_digest(source)
+
+    def skip_unchanged_documents(self, transformed_batch: list) -> tuple[list, list]:
+        """
+        Отбрасывает документы, _source которых не изменился
+        с последней успешной загрузки
+        Args:
+            transformed_batch: список bulk-действий
+        Returns:
+            действия для загрузки и их разбор из action_digest
+        """
+        parsed = [self.action_digest(action) for action in transformed_batch]
+        if not self.skip_unchanged:
+            return transformed_batch, parsed
+
+        stored = self.digests.retrieve_digests(
+            [film_id for _, film_id, digest in parsed if digest is not None]
+        )
+        to_load = [
+            (action, item) for action, item in zip(transformed_batch, parsed)
+            if item[2] is None or stored.get(item[1]) != item[2]
+        ]
+        skipped = len(transformed_batch) - len(to_load)
+        if not skipped:
+            return transformed_batch, parsed
+
+        self.writes_avoided += skipped
+        metrics.WRITES_AVOIDED.labels(self.index_name).inc(skipped)
+        self.logger.info(
+            'Skipped %d unchanged documents, %d writes avoided in total',
+            skipped, self.writes_avoided
+        )
+        return [action for action, _ in to_load], [item for _, item in to_load]
+
+    def save_digests(self, parsed: list, report: BulkReport) -> None:
+        """
+        Запоминает хэши успешно загруженных документов
+        и забывает хэши удалённых
+        Args:
+            parsed: разбор загруженных действий из action_digest
+            report: отчёт о загрузке
+        """
+        failed = {str(failure['_id']) for failure in report.failed}
+        self.digests.save_digests({
+            film_id: digest for _, film_id, digest in parsed
+            if digest is not None and film_id not in failed
+        })
+        deleted = [
+            film_id for _, film_id, digest in parsed
+            if digest is None and film_id not in failed
+        ]
+        if deleted:
+            self.digests.delete_digests(deleted)
+
+    @staticmethod
+    def is_permanent_error(error: Exception) -> bool:
+        """
+        Отличает ошибку всего bulk-запроса, которая повторится при повторе
+        (ошибка сериализации, ответ 4xx кроме 429), от временной
+        """
+        if isinstance(error, SerializationError):
+            return True
+        status = getattr(error, 'status_code', None)
+        return isinstance(status, int) and 400 <= status < 500 and status != 429
+
+    @staticmethod
+    def reject_batch(transformed_batch: list, error: Exception) -> BulkReport:
+        """
+        Отчёт, в котором все документы пачки не загружены из-за ошибки запроса
         Args:
-            transformed_batch: список словарей с данными
+            transformed_batch: список bulk-действий
+            error: ошибка bulk-запроса
         Returns:
-            список id загруженных документов
+            отчёт о загрузке
         """
-        with es_connection(self.dsn) as es:
-            if not es.ping():
-                raise Exception('Elasticsearch is not available')
-            bulk(es, transformed_batch)
+        report = BulkReport()
+        for action in transformed_batch:
+            header, _ = expand_raw_action(action)
+            op_type, meta = next(iter(header.items()))
+            report.add(False, {op_type: {
+                '_id': meta.get('_id'),
+                'status': getattr(error, 'status_code', None),
+                'error': str(error)
+            }})
+        return report
+
+    def save_dead_letters(
+        self,
+        transformed_batch: list,
+        report: BulkReport,
+        checkpoint: Optional[dict]
+    ) -> None:
+        """
+        Сохраняет незагруженные документы вместе с ошибкой Elasticsearch
+        и watermark'ом пачки
+        Args:
+            transformed_batch: список bulk-действий
+            report: отчёт о загрузке
+            checkpoint: словарь состояний пачки
+        """
+        letters = dead_letter_records(self.index_name, transformed_batch, report, checkpoint)
+        self.dead_letters.save_letters(letters)
+        self.logger.warning('%d documents saved to dead letters', len(letters))
+
+    @backoff()
+    def load(
+        self,
+        transformed_batch: list,
+        checkpoint: Optional[dict] = None,
+        dead_letter: bool = True
+    ) -> BulkReport:
+        """
+        Загрузка данных в Elasticsearch.
+        Ошибки отдельных документов и неисправимые ошибки запроса
+        не останавливают ETL: документы сохраняются в dead letters
+        Args:
+            transformed_batch: список bulk-действий: словарей
+                или пар (заголовок, json документа)
+            checkpoint: словарь состояний пачки для записи в dead letters
+            dead_letter: сохранять ли незагруженные документы
+        Returns:
+            поэлементный отчёт о загрузке
+        """
+        if self.digests is not None:
+            transformed_batch, parsed = self.skip_unchanged_documents(transformed_batch)
+            if not transformed_batch:
+                return BulkReport()
+
+        chunk_size = None
+        if self.batch_controller is not None:
+            # пачка уходит одним bulk-запросом на поток,
+            # чтобы задержка запроса отражала размер пачки
+            chunk_size = -(-len(transformed_batch) // self.indexer.thread_count)
+        payload_bytes = estimate_payload_bytes(transformed_batch)
+
+        started = time.monotonic()
+        try:
+            report = self.indexer.index(
+                self.es,
+                transformed_batch,
+                index=self.write_index,
+                chunk_size=chunk_size
+            )
+        except ConnectionError:
+            if self.batch_controller is not None:
+                # таймаут или обрыв считаются отказом всей пачки
+                self.batch_controller.observe(
+                    len(transformed_batch),
+                    time.monotonic() - started,
+                    len(transformed_batch),
+                    payload_bytes
+                )
+            self.on_connection_error()
+            metrics.RETRIES.labels(self.index_name, 'load').inc()
+            raise
+        except (SerializationError, TransportError) as error:
+            if not self.is_permanent_error(error):
+                metrics.RETRIES.labels(self.index_name, 'load').inc()
+                raise
+            self.logger.error('Bulk request rejected: %s', error)
+            report = self.reject_batch(transformed_batch, error)
+        else:
+            if self.batch_controller is not None:
+                self.batch_controller.observe(
+                    len(transformed_batch),
+                    time.monotonic() - started,
+                    report.rejected,
+                    payload_bytes
+                )
+
+        metrics.observe_stage(
+            self.index_name, 'load', len(transformed_batch), time.monotonic() - started
+        )
+        metrics.BYTES.labels(self.index_name).inc(payload_bytes)
+        metrics.DOCUMENTS_RETRIED.labels(self.index_name).inc(report.retried)
+        metrics.FAILED.labels(self.index_name).inc(len(report.failed))
+
+        if self.digests is not None:
+            self.save_digests(parsed, report)
+
+        if self.batch_controller is not None:
+            self.logger.info(
+                'Bulk finished: %s, batch size: %d',
+                report, self.batch_controller.size
+            )
+        else:
+            self.logger.info('Bulk finished: %s', report)
+        for failure in report.failed:
+            self.logger.error(
+                'Document %s was not indexed: %s %s',
+                failure['_id'], failure['status'], failure['error']
+            )
+        if dead_letter and report.failed and self.dead_letters is not None:
+            self.save_dead_letters(transformed_batch, report, checkpoint)
+        return report
@@ -0,0 +1,35 @@
+from typing import NamedTuple
+
+from etl_utils.config import (ESIndexConfig, GenresIndexConfig,
+                              PersonsIndexConfig)
+
+from .elasticsearch_loader import ElasticsearchLoader
+from .postgres_extractor import PostgresExtractor
+from .queries import (GENRES_QUERIES, MOVIES_QUERIES, PERSONS_QUERIES,
+                      ExtractionQueries)
+from .transformer import GenresTransformer, PersonsTransformer, Transformer
+
+
+class IndexDefinition(NamedTuple):
+    """
+    Описание индекса Elasticsearch: настройки и маппинг индекса,
+    запросы извлечения из Postgres и класс трансформации
+    """
+    index_config: ESIndexConfig
+    queries: ExtractionQueries
+    transformer: type[Transformer]
+
+
+INDEXES = {
+    'movies': IndexDefinition(ESIndexConfig(), MOVIES_QUERIES, Transformer),
+    'persons': IndexDefinition(PersonsIndexConfig(), PERSONS_QUERIES, PersonsTransformer),
+    'genres': IndexDefinition(GenresIndexConfig(), GENRES_QUERIES, GenresTransformer),
+}
+
+
+class IndexPipeline(NamedTuple):
+    """Стадии ETL одного индекса"""
+    name: str
+    extractor: PostgresExtractor
+    transformer: Transformer
+    loader: ElasticsearchLoader
@@ -0,0 +1,152 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable
+
+from etl_utils import metrics
+from etl_utils.state_storage import State
+
+from .elasticsearch_loader import ElasticsearchLoader
+from .postgres_extractor import PostgresExtractor
+from .transformer import Transformer
+
+_DONE = object()
+
+
+class Pipeline:
+    """
+    Конвейерный ETL процесс: извлечение, трансформация и загрузка
+    выполняются одновременно в отдельных потоках, связанных
+    ограниченными очередями. Загрузка идёт в одном потоке по порядку,
+    поэтому состояние сохраняется только после загрузки
+    всех предыдущих пачек.
+    """
+    def __init__(
+        self,
+        extractor: PostgresExtractor,
+        transformer: Transformer,
+        loader: ElasticsearchLoader,
+        state: State,
+        logger: logging.Logger,
+        queue_size: int = 4
+    ) -> None:
+        self.extractor = extractor
+        self.transformer = transformer
+        self.loader = loader
+        self.state = state
+        self.logger = logger
+        self.queue_size = queue_size
+
+    def run(self) -> None:
+        """
+        Запустить конвейер и дождаться его завершения.
+        Ошибка в любом потоке останавливает остальные
+        и пробрасывается в вызывающий поток.
+        """
+        self.stop = threading.Event()
+        self.errors = []
+        transform_queue = queue.Queue(maxsize=self.queue_size)
+        load_queue = queue.Queue(maxsize=self.queue_size)
+        self.queues = {'transform': transform_queue, 'load': load_queue}
+
+        threads = [
+            threading.Thread(
+                target=self._worker,
+                args=(self._extract, transform_queue),
+                name='etl-extract'
+            ),
+            threading.Thread(
+                target=self._worker,
+                args=(self._transform, transform_queue, load_queue),
+                name='etl-transform'
+            ),
+            threading.Thread(
+                target=self._worker,
+                args=(self._load, load_queue),
+                name='etl-load'
+            ),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+    def _worker(self, target: Callable, *queues: queue.Queue) -> None:
+        """Запускает стадию и останавливает конвейер при ошибке"""
+        try:
+            target(*queues)
+        except Exception as error:
+            self.logger.exception('ETL pipeline stage failed')
+            self.errors.append(error)
+            self.stop.set()
+
+    def _put(self, output: queue.Queue, item: Any) -> bool:
+        """
+        Кладёт элемент в очередь, ожидая свободное место
+        Returns:
+            False, если конвейер остановлен
+        """
+        while not self.stop.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source: queue.Queue) -> Any:
+        """
+        Забирает элемент из очереди
+        Returns:
+            элемент очереди или _DONE, если конвейер остановлен
+        """
+        while not self.stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _extract(self, output: queue.Queue) -> None:
+        index = self.loader.index_name
+        batches = self.extractor.extract()
+        try:
+            tracked = metrics.track_batches(index, self.extractor, batches)
+            for i, (batch, checkpoint) in enumerate(tracked, start=1):
+                self.logger.info('Extracted %d batch', i)
+                if not self._put(output, (i, batch, checkpoint)):
+                    return
+                metrics.observe_queues(index, self.queues)
+        finally:
+            batches.close()
+        self._put(output, _DONE)
+
+    def _transform(self, source: queue.Queue, output: queue.Queue) -> None:
+        while (item := self._get(source)) is not _DONE:
+            i, batch, checkpoint = item
+            started = time.monotonic()
+            transformed_batch = self.transformer.transform(batch)
+            metrics.observe_stage(
+                self.loader.index_name, 'transform', len(batch), time.monotonic() - started
+            )
+            self.logger.info('Transformed %d batch', i)
+            if not self._put(output, (i, transformed_batch, checkpoint)):
+                return
+        self._put(output, _DONE)
+
+    def _load(self, source: queue.Queue) -> None:
+        while (item := self._get(source)) is not _DONE:
+            i, transformed_batch, checkpoint = item
+            if transformed_batch:
+                self.loader.load(transformed_batch, checkpoint)
+            self.logger.info('Loaded %d batch', i)
+            self.state.commit(checkpoint)
+            metrics.observe_checkpoint(self.loader.index_name, checkpoint)
+            metrics.observe_queues(self.loader.index_name, self.queues)
+        # при работе по партициям отставание считает run_partitions
+        if not self.stop.is_set() and self.extractor.partition is None:
+            metrics.observe_pending(self.loader.index_name, self.extractor.oldest_pending())
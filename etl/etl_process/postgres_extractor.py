@@ -1,69 +1,495 @@
-import datetime
 import logging
-from typing import Iterator
+import time
+from datetime import datetime
+from itertools import islice
+from typing import Any, Iterator, Optional
 
+import psycopg2
 import psycopg2.extras
-from etl_utils.connection_config import pg_connection
+from etl_utils import metrics
+from etl_utils.connection_config import PostgresConnection
 from etl_utils.state_storage import State
 
+from .batch_controller import BatchSizeController
+from .queries import (CHANGE_LOG_HORIZON_QUERY, CHANGE_LOG_PENDING_QUERY,
+                      CHANGE_LOG_PRUNE_QUERY, CHANGE_LOG_QUERY, MOVIES_QUERIES,
+                      PARTITION_FILTER, PENDING_QUERY, PRODUCER_QUERY,
+                      ExtractionQueries)
+from .transformer import Deletion
+
+DEFAULT_WATERMARK = {
+    'modified': '1970-01-01 00:00:00.000000+00',
+    'id': '00000000-0000-0000-0000-000000000000'
+}
+
+
+def partition_of(film_id: str, partitions: int) -> int:
+    """
+    Номер партиции фильма, то же вычисление, что PARTITION_FILTER в SQL
+    Args:
+        film_id: id фильма
+        partitions: число партиций
+    Returns:
+        номер партиции
+    """
+    return int(str(film_id)[:8], 16) % partitions
+
+
+def partition_state_key(key: str, partition: Optional[tuple[int, int]]) -> str:
+    """
+    Ключ состояния с учётом партиции, у каждой партиции свои watermark'и
+    Args:
+        key: ключ состояния
+        partition: номер партиции и число партиций или None
+    Returns:
+        ключ состояния
+    """
+    if partition is None:
+        return key
+    return f'{key}:p{partition[0]}of{partition[1]}'
+
 
 class PostgresExtractor:
-    """Извлекает данные из Postgres"""
-    def __init__(self, pg_dsn: dict, batch_size: int, state: State, logger: logging.Logger) -> None:
-        self.batch_size = batch_size
+    """
+    Извлекает данные одного индекса из Postgres.
+    Набор таблиц и запросов индекса задаётся ExtractionQueries
+    """
+    def __init__(
+        self,
+        pg_dsn: dict,
+        batch_size: int,
+        state: State,
+        logger: logging.Logger,
+        itersize: int = 1000,
+        server_side_cursor: bool = True,
+        raw_documents: bool = False,
+        source: str = 'modified',
+        queries: ExtractionQueries = MOVIES_QUERIES,
+        connection=None,
+        batch_controller: BatchSizeController = None,
+        index_name: str = 'movies'
+    ) -> None:
+        self.fixed_batch_size = batch_size
+        self.batch_controller = batch_controller
+        # имя индекса для метрик
+        self.index_name = index_name
         self.state = state
         self.logger = logger
         self.pg_dsn = pg_dsn
+        # общий пул подключений не закрывается вместе с экстрактором
+        self.owns_connection = connection is None
+        self.connection = connection or PostgresConnection(pg_dsn)
+        self.itersize = itersize
+        self.server_side_cursor = server_side_cursor
+        self.queries = queries
+        self.raw_documents = raw_documents and queries.document_merger is not None
+        self.source = source if queries.change_log else 'modified'
+        # id документов, изменённых через связи, из уведомлений
+        self.pending_film_ids = set()
+        # ключи позиций всех индексов, читающих журнал изменений
+        self.change_log_keys = None
+        self.partition = None
+        self.progress = {}
+        self.notified_extracted = set()
+
+    @property
+    def batch_size(self) -> int:
+        """Текущий размер пачки: постоянный или подобранный по нагрузке"""
+        if self.batch_controller is None:
+            return self.fixed_batch_size
+        return self.batch_controller.size
+
+    def _cursor(self, conn, name: str):
+        """
+        Создаёт курсор для извлечения данных.
+        Именованный (серверный) курсор не тянет весь результат запроса
+        в память процесса, а подгружает его порциями по itersize строк.
+        Args:
+            conn: объект подключения к Postgres
+            name: имя серверного курсора
+        Returns:
+            курсор Postgres
+        """
+        if not self.server_side_cursor:
+            return conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+        cursor = conn.cursor(
+            name=name,
+            cursor_factory=psycopg2.extras.DictCursor
+        )
+        cursor.itersize = self.itersize
+        return cursor
+
+    def state_key(self, key: str) -> str:
+        """Ключ состояния индекса для текущей партиции"""
+        return partition_state_key(self.queries.state_prefix + key, self.partition)
+
+    def in_partition(self, film_id: str) -> bool:
+        """Относится ли фильм к текущей партиции"""
+        if self.partition is None:
+            return True
+        return partition_of(film_id, self.partition[1]) == self.partition[0]
+
+    def extract(self) -> Iterator[tuple[list, dict]]:
+        """
+        Извлекает изменённые документы индекса из Postgres.
+        Изменения ищутся отдельно по каждой таблице из queries.enrichers
+        (для фильмов - film_work, genre и person),
+        у каждой таблицы свой watermark в State.
+        При source='change_log' изменения читаются из журнала content.change_log.
+        Перед ними извлекаются фильмы из pending_film_ids,
+        изменения которых пришли уведомлениями.
+        Если задана partition, извлекаются только фильмы этой партиции.
+        После обрыва связи с Postgres извлечение продолжается
+        с пачки, на которой оборвалось, а не с начала прохода
+        Yields:
+            Пачка записей из Postgres и словарь состояний,
+            который нужно сохранить после загрузки пачки
+        """
+        film_ids = {film_id for film_id in self.pending_film_ids if self.in_partition(film_id)}
+        self.pending_film_ids -= film_ids
+        self.progress = {}
+        self.notified_extracted = set()
+        sleep_time = 0.1
+        try:
+            while True:
+                try:
+                    yield from self._extract(sorted(film_ids - self.notified_extracted))
+                    return
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    self.logger.exception('Postgres connection lost, resuming extraction')
+                    self.logger.info('Waiting %s seconds...', sleep_time)
+                    metrics.RETRIES.labels(self.index_name, 'extract').inc()
+                    time.sleep(sleep_time)
+                    sleep_time = min(sleep_time * 2, 10)
+        except BaseException:
+            self.pending_film_ids |= film_ids
+            raise
+
+    def _extract(self, film_ids: list[str]) -> Iterator[tuple[list, dict]]:
+        """
+        Один проход извлечения в транзакции с позиций из progress.
+        Журнал изменений чистится до неё отдельной короткой транзакцией,
+        чтобы блокировки удалённых строк не держались весь проход
+        Args:
+            film_ids: id фильмов из уведомлений
+        Yields:
+            Пачка записей из Postgres и словарь состояний
+        """
+        if self.source == 'change_log':
+            # удаляется только то, что уже сохранено после загрузки
+            self.prune_change_log(self.change_log_floor())
+        with self.connection.transaction() as conn:
+            yield from self.extract_films(conn, film_ids)
+            if self.source == 'change_log':
+                yield from self.extract_change_log(conn)
+                return
+            for table in self.queries.enrichers:
+                yield from self.extract_table(conn, table)
+
+    def position(self, key: str) -> Any:
+        """
+        Позиция извлечения по ключу состояния: последняя выданная
+        в этом проходе или сохранённая в State
+        Args:
+            key: ключ состояния
+        Returns:
+            значение состояния
+        """
+        if key in self.progress:
+            return self.progress[key]
+        return self.state.get_state(key)
+
+    def _yield_checkpoint(self, batch: list, checkpoint: dict) -> tuple[list, dict]:
+        """Запоминает позицию выданной пачки для продолжения после обрыва"""
+        self.progress.update(checkpoint)
+        return batch, checkpoint
+
+    def extract_films(self, conn, film_ids: list[str]) -> Iterator[tuple[list, dict]]:
+        """
+        Извлекает фильмы по списку id без изменения watermark'ов
+        Args:
+            conn: объект подключения к Postgres
+            film_ids: id фильмов
+        Yields:
+            Пачка записей из Postgres и пустой словарь состояний
+        """
+        size = self.batch_size
+        for i in range(0, len(film_ids), size):
+            batch = self.merge(conn, film_ids[i:i + size])
+            self.logger.info('Extracted %d notified rows from Postgres', len(batch))
+            self.notified_extracted.update(film_ids[i:i + size])
+            yield batch, {}
+
+    def extract_table(self, conn, table: str) -> Iterator[tuple[list, dict]]:
+        """
+        Прогоняет изменения одной таблицы через стадии
+        producer -> enricher -> merger
+        Args:
+            conn: объект подключения к Postgres
+            table: имя таблицы в схеме content
+        Yields:
+            Пачка записей из Postgres и словарь состояний
+        """
+        state_key = self.state_key(f'{table}_watermark')
+        watermark = self.position(state_key) or DEFAULT_WATERMARK
+        self.logger.info('Extracting %s after watermark %s', table, watermark)
+
+        query = PRODUCER_QUERY.format(table=table, partition='')
+        params = dict(watermark)
+        if self.partition is not None and self.queries.enrichers[table] is None:
+            query = PRODUCER_QUERY.format(table=table, partition=PARTITION_FILTER)
+            params.update(partition=self.partition[0], partitions=self.partition[1])
+
+        with self._cursor(conn, f'{table}_producer') as producer:
+            producer.execute(query, params)
+
+            while changed := list(islice(producer, self.batch_size)):
+                self.logger.info('Produced %d changed %s rows', len(changed), table)
+                film_ids = [
+                    film_id for film_id in
+                    self.enrich(conn, table, [row['id'] for row in changed])
+                    if self.in_partition(film_id)
+                ]
+                checkpoint = {
+                    state_key: {
+                        'modified': changed[-1]['modified'].isoformat(),
+                        'id': str(changed[-1]['id'])
+                    }
+                }
+
+                size = self.batch_size
+                chunks = [
+                    film_ids[i:i + size]
+                    for i in range(0, len(film_ids), size)
+                ] or [[]]
+                for i, chunk in enumerate(chunks, start=1):
+                    batch = self.merge(conn, chunk)
+                    self.logger.info('Extracted %d rows from Postgres', len(batch))
+                    if i < len(chunks):
+                        yield batch, {}
+                    else:
+                        yield self._yield_checkpoint(batch, checkpoint)
 
-    def extract(self, last_etl_process_time: datetime.datetime) -> Iterator:
+    def extract_change_log(self, conn) -> Iterator[tuple[list, dict]]:
         """
-        Извлекает данные из Postgres
+        Извлекает изменения из журнала content.change_log после позиции
+        (txid, seq) до горизонта xmin. Записи ещё не завершённых транзакций
+        остаются в следующий проход, а после прохода позицией становится
+        горизонт. Журнал заполняется триггерами, в том числе при удалении,
+        поэтому удалённые фильмы превращаются в строки Deletion
         Args:
-            last_etl_process_time: время последнего запуска ETL процесса
+            conn: объект подключения к Postgres
         Yields:
-            Итератор по записям из Postgres
-        """
-        with pg_connection(self.pg_dsn) as conn:
-            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-                query = f"""
-                    SELECT
-                        fw.id,
-                        fw.title,
-                        fw.description,
-                        fw.rating,
-                        fw.type,
-                        fw.created,
-                        fw.modified,
-                        COALESCE (
-                            json_agg(
-                                DISTINCT jsonb_build_object(
-                                    'person_role', pfw.role,
-                                    'person_id', p.id,
-                                    'person_name', p.full_name
-                                )
-                            ) FILTER (WHERE p.id is not null),
-                            '[]'
-                        ) as persons,
-                        array_agg(DISTINCT g.name) as genres
-                        FROM content.film_work fw
-                        LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
-                        LEFT JOIN content.person p ON p.id = pfw.person_id
-                        LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
-                        LEFT JOIN content.genre g ON g.id = gfw.genre_id
-                        GROUP BY fw.id
-                        HAVING GREATEST(fw.modified, MAX(p.modified), MAX(g.modified)) > '{last_etl_process_time}'
-                    """
-                previous_extracted_ids = tuple(self.state.get_state('previous_extracted_ids'))
-                if previous_extracted_ids:
-                    query += f'AND fw.id NOT IN {previous_extracted_ids} '
-                    query += 'ORDER BY GREATEST(fw.modified, MAX(p.modified), MAX(g.modified));'
-
-                cursor.execute(query)
-
-                while batch := cursor.fetchmany(self.batch_size):
+            Пачка записей из Postgres и словарь состояний
+        """
+        state_key = self.state_key('change_log_position')
+        position = self.position(state_key) or {'txid': 0, 'seq': 0}
+        horizon = self.change_log_horizon(conn)
+        self.logger.info(
+            'Extracting change log after txid %s seq %s before txid %s',
+            position['txid'], position['seq'], horizon
+        )
+
+        with self._cursor(conn, 'change_log_producer') as producer:
+            producer.execute(CHANGE_LOG_QUERY, {**position, 'horizon': horizon})
+
+            while changes := list(islice(producer, self.batch_size)):
+                self.logger.info('Read %d change log rows', len(changes))
+                film_ids, deleted = self.resolve_changes(conn, changes)
+                checkpoint = {
+                    state_key: {'txid': changes[-1]['txid'], 'seq': changes[-1]['seq']}
+                }
+
+                size = self.batch_size
+                chunks = [
+                    film_ids[i:i + size]
+                    for i in range(0, len(film_ids), size)
+                ] or [[]]
+                for i, chunk in enumerate(chunks, start=1):
+                    batch = self.merge(conn, chunk)
+                    if i < len(chunks):
+                        yield batch, {}
+                        continue
+                    batch += [Deletion(film_id) for film_id in deleted]
                     self.logger.info('Extracted %d rows from Postgres', len(batch))
-                    self.state.set_state(
-                        'previous_extracted_ids',
-                        [self.state.get_state('previous_extracted_ids').append(row['id']) for row in batch]
-                    )
-                    yield batch
+                    yield self._yield_checkpoint(batch, checkpoint)
+
+        # все записи до горизонта прочитаны, следующая транзакция
+        # может записать только txid не меньше горизонта
+        if horizon > position['txid']:
+            yield self._yield_checkpoint([], {state_key: {'txid': horizon, 'seq': 0}})
+
+    def resolve_changes(self, conn, changes: list) -> tuple[list[str], list[str]]:
+        """
+        Сводит записи журнала к id документов для обновления и удаления.
+        Документ определяется записью queries.document_table или колонкой
+        queries.change_log_key (для фильмов - film_work_id связей,
+        для персон - person_id связей), остальные таблицы из enrichers
+        переводятся в id документов запросами обогащения
+        Args:
+            conn: объект подключения к Postgres
+            changes: записи content.change_log в порядке (txid, seq)
+        Returns:
+            id документов для обновления и id удалённых документов
+        """
+        document_ids = set()
+        deleted = set()
+        entities = {}
+        document_table = self.queries.document_table
+        key = self.queries.change_log_key
+
+        for change in changes:
+            table = change['table_name']
+            if table == document_table and change['op'] == 'DELETE':
+                deleted.add(str(change['entity_id']))
+            elif table == document_table:
+                deleted.discard(str(change['entity_id']))
+                document_ids.add(str(change['entity_id']))
+            elif change[key] is not None:
+                document_ids.add(str(change[key]))
+            elif change['op'] != 'DELETE' and table in self.queries.enrichers:
+                entities.setdefault(table, set()).add(str(change['entity_id']))
+
+        for table, ids in entities.items():
+            document_ids.update(str(id_) for id_ in self.enrich(conn, table, list(ids)))
+
+        document_ids = {id_ for id_ in document_ids - deleted if self.in_partition(id_)}
+        deleted = {id_ for id_ in deleted if self.in_partition(id_)}
+        return sorted(document_ids), sorted(deleted)
+
+    def oldest_pending(self) -> Optional[datetime]:
+        """
+        Время самого старого изменения, которое индекс ещё не загрузил,
+        по сохранённым позициям текущей партиции: записи журнала
+        при source='change_log', иначе строки после watermark'ов таблиц
+        Returns:
+            время изменения или None, если всё загружено
+        """
+        with self.connection.transaction() as conn, conn.cursor() as cursor:
+            if self.source == 'change_log':
+                position = self.state.get_state(self.state_key('change_log_position'))
+                cursor.execute(CHANGE_LOG_PENDING_QUERY, position or {'txid': 0, 'seq': 0})
+                return cursor.fetchone()[0]
+
+            oldest = []
+            for table in self.queries.enrichers:
+                watermark = self.state.get_state(self.state_key(f'{table}_watermark'))
+                query = PENDING_QUERY.format(table=table, partition='')
+                params = dict(watermark or DEFAULT_WATERMARK)
+                if self.partition is not None and self.queries.enrichers[table] is None:
+                    query = PENDING_QUERY.format(table=table, partition=PARTITION_FILTER)
+                    params.update(partition=self.partition[0], partitions=self.partition[1])
+                cursor.execute(query, params)
+                modified = cursor.fetchone()[0]
+                if modified is not None:
+                    oldest.append(modified)
+            return min(oldest, default=None)
+
+    def change_log_horizon(self, conn=None) -> int:
+        """
+        Возвращает горизонт xmin: транзакции с меньшим txid завершены
+        и их записи журнала уже видны
+        Args:
+            conn: объект подключения к Postgres, по умолчанию из пула
+        Returns:
+            txid горизонта
+        """
+        if conn is None:
+            with self.connection.transaction() as conn:
+                return self.change_log_horizon(conn)
+        with conn.cursor() as cursor:
+            cursor.execute(CHANGE_LOG_HORIZON_QUERY)
+            return cursor.fetchone()[0]
+
+    def change_log_floor(self) -> int:
+        """
+        Позиция журнала, до которой его уже загрузили все читающие
+        журнал индексы и партиции: минимальный txid их позиций в хранилище.
+        При работе по партициям позиции сохраняют другие воркеры,
+        поэтому они читаются из хранилища, а не из памяти
+        Returns:
+            txid, до которого журнал можно удалить, или 0
+        """
+        keys = self.change_log_keys or [self.state_key('change_log_position')]
+        stored = self.state.stored()
+        positions = [stored.get(key) for key in keys]
+        if not all(positions):
+            return 0
+        return min(position['txid'] for position in positions)
+
+    def prune_change_log(self, txid: int) -> None:
+        """
+        Удаляет из журнала записи, уже загруженные в Elasticsearch,
+        в своей транзакции, которая фиксируется сразу после удаления
+        Args:
+            txid: минимальный txid сохранённых позиций
+        """
+        if not txid:
+            return
+        with self.connection.transaction() as conn, conn.cursor() as cursor:
+            cursor.execute(CHANGE_LOG_PRUNE_QUERY, (txid,))
+            self.logger.info('Pruned %d change log rows', cursor.rowcount)
+
+    def enrich(self, conn, table: str, ids: list[str]) -> list[str]:
+        """
+        Находит id фильмов, затронутых изменёнными записями
+        Args:
+            conn: объект подключения к Postgres
+            table: имя таблицы, в которой найдены изменения
+            ids: id изменённых записей
+        Returns:
+            список id фильмов
+        """
+        query = self.queries.enrichers[table]
+        if query is None:
+            return ids
+
+        with conn.cursor() as cursor:
+            cursor.execute(query, (ids,))
+            return [row[0] for row in cursor.fetchall()]
+
+    def extract_documents(self, ids: list[str], conn=None) -> list:
+        """
+        Извлекает текущие данные документов по id, например
+        для повторной загрузки. Документы, которых уже нет в Postgres,
+        превращаются в строки Deletion
+        Args:
+            ids: id документов
+            conn: объект подключения к Postgres, по умолчанию из пула
+        Returns:
+            пачка записей из Postgres
+        """
+        if conn is None:
+            with self.connection.transaction() as conn:
+                return self.extract_documents(ids, conn)
+        batch = self.merge(conn, ids)
+        found = {str(row[0]) for row in batch}
+        return batch + [Deletion(id_) for id_ in ids if str(id_) not in found]
+
+    def merge(self, conn, film_ids: list[str]) -> list:
+        """
+        Собирает полные данные по фильмам.
+        В режиме raw_documents возвращает пары (id, json документа)
+        Args:
+            conn: объект подключения к Postgres
+            film_ids: id фильмов
+        Returns:
+            список записей из Postgres
+        """
+        if not film_ids:
+            return []
+
+        if self.raw_documents:
+            with conn.cursor() as cursor:
+                cursor.execute(self.queries.document_merger, (film_ids,))
+                return cursor.fetchall()
+
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            cursor.execute(self.queries.merger, (film_ids,))
+            return cursor.fetchall()
+
+    def close(self) -> None:
+        """Закрывает подключение к Postgres, если оно не общее"""
+        if self.owns_connection:
+            self.connection.close()
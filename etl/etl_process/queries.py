@@ -0,0 +1,272 @@
+"""SQL-запросы стадий извлечения данных из Postgres"""
+from typing import NamedTuple, Optional
+
+# Producer: изменённые записи таблицы по индексу (modified, id)
+PRODUCER_QUERY = """
+    SELECT id, modified
+    FROM content.{table}
+    WHERE (modified, id) > (%(modified)s::timestamptz, %(id)s::uuid)
+    {partition}
+    ORDER BY modified, id
+"""
+
+# Producer для asyncpg: тот же запрос с позиционными параметрами
+# вместо именованных, значения watermark'а передаются строками
+ASYNC_PRODUCER_QUERY = PRODUCER_QUERY.replace(
+    '%(modified)s::timestamptz', '$1::text::timestamptz'
+).replace(
+    '%(id)s::uuid', '$2::text::uuid'
+)
+
+# Время самого старого изменения таблицы после watermark'а,
+# по нему считается отставание индекса
+PENDING_QUERY = """
+    SELECT MIN(modified)
+    FROM content.{table}
+    WHERE (modified, id) > (%(modified)s::timestamptz, %(id)s::uuid)
+    {partition}
+"""
+
+ASYNC_PENDING_QUERY = PENDING_QUERY.replace(
+    '%(modified)s::timestamptz', '$1::text::timestamptz'
+).replace(
+    '%(id)s::uuid', '$2::text::uuid'
+)
+
+# Фильтр партиции фильма: первые 32 бита uuid по модулю числа партиций
+PARTITION_FILTER = """
+    AND mod(('x' || substr(id::text, 1, 8))::bit(32)::bigint, %(partitions)s) = %(partition)s
+"""
+
+# Enricher: id фильмов, связанных с изменёнными записями
+ENRICHER_QUERIES = {
+    'film_work': None,
+    'genre': """
+        SELECT DISTINCT film_work_id
+        FROM content.genre_film_work
+        WHERE genre_id = ANY(%s::uuid[])
+    """,
+    'person': """
+        SELECT DISTINCT film_work_id
+        FROM content.person_film_work
+        WHERE person_id = ANY(%s::uuid[])
+    """,
+}
+
+# Версия фильма: хэш содержимого документа - полей фильма, имён жанров
+# и ролей, id и имён персон. Времена изменения в версию не входят,
+# поэтому сохранение без изменения содержимого не меняет хэш документа.
+# Пишется в документ и сравнивается при сверке
+FILM_VERSION = """
+        md5(json_build_array(
+            fw.title,
+            fw.description,
+            fw.rating,
+            string_agg(DISTINCT g.name, ',' ORDER BY g.name),
+            string_agg(
+                DISTINCT pfw.role || ':' || p.id::text || ':' || p.full_name,
+                ','
+                ORDER BY pfw.role || ':' || p.id::text || ':' || p.full_name
+            )
+        )::text)"""
+
+FILM_JOINS = """
+    FROM content.film_work fw
+    LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+    LEFT JOIN content.person p ON p.id = pfw.person_id
+    LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+    LEFT JOIN content.genre g ON g.id = gfw.genre_id"""
+
+# Merger: полные данные только по переданным id фильмов
+MERGER_QUERY = """
+    SELECT
+        fw.id,
+        fw.title,
+        fw.description,
+        fw.rating,
+        fw.type,
+        fw.created,
+        fw.modified,
+        COALESCE (
+            json_agg(
+                DISTINCT jsonb_build_object(
+                    'person_role', pfw.role,
+                    'person_id', p.id,
+                    'person_name', p.full_name
+                )
+            ) FILTER (WHERE p.id is not null),
+            '[]'
+        ) as persons,
+        array_agg(DISTINCT g.name) as genres,""" + FILM_VERSION + """ as version""" + FILM_JOINS + """
+    WHERE fw.id = ANY(%s::uuid[])
+    GROUP BY fw.id
+"""
+
+# Merger для быстрого пути: Postgres сам собирает _source документа,
+# документ возвращается текстом и не разбирается в Python
+MERGER_DOCUMENT_QUERY = """
+    SELECT
+        fw.id,
+        json_build_object(
+            'id', fw.id,
+            'imdb_rating', fw.rating,
+            'genre', array_agg(DISTINCT g.name),
+            'title', fw.title,
+            'description', fw.description,
+            'director', COALESCE(
+                to_json(MAX(p.full_name) FILTER (WHERE pfw.role = 'director')),
+                '[]'::json
+            ),
+            'actors_names', COALESCE(
+                array_agg(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'actor'),
+                '{}'
+            ),
+            'writers_names', COALESCE(
+                array_agg(DISTINCT p.full_name) FILTER (WHERE pfw.role = 'writer'),
+                '{}'
+            ),
+            'actors', COALESCE(
+                json_agg(
+                    DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name)
+                ) FILTER (WHERE pfw.role = 'actor'),
+                '[]'
+            ),
+            'writers', COALESCE(
+                json_agg(
+                    DISTINCT jsonb_build_object('id', p.id, 'name', p.full_name)
+                ) FILTER (WHERE pfw.role = 'writer'),
+                '[]'
+            ),
+            'version',""" + FILM_VERSION + """
+        )::text AS document""" + FILM_JOINS + """
+    WHERE fw.id = ANY(%s::uuid[])
+    GROUP BY fw.id
+"""
+
+# Сверка: id и версии всех фильмов в порядке id,
+# порядок uuid совпадает с порядком их строк в Elasticsearch
+RECONCILE_QUERY = """
+    SELECT fw.id::text AS id,""" + FILM_VERSION + """ AS version""" + FILM_JOINS + """
+    GROUP BY fw.id
+    ORDER BY fw.id
+"""
+
+# Producer по журналу изменений: новые записи content.change_log
+# после позиции (txid, seq). Транзакции с txid от горизонта xmin
+# ещё могут быть не завершены, а seq выдаётся до коммита,
+# поэтому читаются только записи завершённых транзакций
+CHANGE_LOG_QUERY = """
+    SELECT txid, seq, table_name, op, entity_id, film_work_id, person_id
+    FROM content.change_log
+    WHERE (txid, seq) > (%(txid)s, %(seq)s)
+      AND txid < %(horizon)s
+    ORDER BY txid, seq
+"""
+
+# Горизонт xmin: все транзакции с меньшим txid уже завершены
+CHANGE_LOG_HORIZON_QUERY = """
+    SELECT txid_snapshot_xmin(txid_current_snapshot())
+"""
+
+# Время самой старой записи журнала после позиции, включая записи
+# ещё не завершённых транзакций
+CHANGE_LOG_PENDING_QUERY = """
+    SELECT MIN(created)
+    FROM content.change_log
+    WHERE (txid, seq) > (%(txid)s, %(seq)s)
+"""
+
+CHANGE_LOG_PRUNE_QUERY = """
+    DELETE FROM content.change_log WHERE txid < %s
+"""
+
+# Enricher индекса persons: id персон изменённых фильмов
+PERSONS_ENRICHER_QUERIES = {
+    'person': None,
+    'film_work': """
+        SELECT DISTINCT person_id
+        FROM content.person_film_work
+        WHERE film_work_id = ANY(%s::uuid[])
+    """,
+}
+
+# Merger индекса persons: id фильмов персоны по ролям
+PERSONS_MERGER_QUERY = """
+    SELECT
+        p.id,
+        p.full_name,
+        COALESCE(
+            array_agg(DISTINCT pfw.film_work_id::text) FILTER (WHERE pfw.role = 'actor'),
+            '{}'
+        ) as actor_film_ids,
+        COALESCE(
+            array_agg(DISTINCT pfw.film_work_id::text) FILTER (WHERE pfw.role = 'writer'),
+            '{}'
+        ) as writer_film_ids,
+        COALESCE(
+            array_agg(DISTINCT pfw.film_work_id::text) FILTER (WHERE pfw.role = 'director'),
+            '{}'
+        ) as director_film_ids
+    FROM content.person p
+    LEFT JOIN content.person_film_work pfw ON pfw.person_id = p.id
+    WHERE p.id = ANY(%s::uuid[])
+    GROUP BY p.id
+"""
+
+# Merger индекса genres
+GENRES_MERGER_QUERY = """
+    SELECT g.id, g.name, g.description
+    FROM content.genre g
+    WHERE g.id = ANY(%s::uuid[])
+"""
+
+
+class ExtractionQueries(NamedTuple):
+    """
+    Запросы извлечения одного индекса:
+    enrichers - таблицы-источники изменений и запросы поиска id документов
+    (None, если id записи и есть id документа),
+    merger - сборка документов по id,
+    document_merger - сборка готового JSON документа в Postgres,
+    state_prefix - префикс ключей состояния индекса,
+    change_log - поддерживает ли индекс чтение журнала изменений,
+    partitioned - делится ли индекс на партиции между воркерами,
+    reconcile - id и версии всех документов в порядке id для сверки,
+    document_table - таблица, id записей которой и есть id документов,
+    change_log_key - колонка журнала изменений и поле уведомлений
+    с id документа, изменённого через связи
+    """
+    enrichers: dict
+    merger: str
+    document_merger: Optional[str] = None
+    state_prefix: str = ''
+    change_log: bool = False
+    partitioned: bool = False
+    reconcile: Optional[str] = None
+    document_table: str = 'film_work'
+    change_log_key: str = 'film_work_id'
+
+
+MOVIES_QUERIES = ExtractionQueries(
+    enrichers=ENRICHER_QUERIES,
+    merger=MERGER_QUERY,
+    document_merger=MERGER_DOCUMENT_QUERY,
+    change_log=True,
+    partitioned=True,
+    reconcile=RECONCILE_QUERY
+)
+
+PERSONS_QUERIES = ExtractionQueries(
+    enrichers=PERSONS_ENRICHER_QUERIES,
+    merger=PERSONS_MERGER_QUERY,
+    state_prefix='persons:',
+    change_log=True,
+    document_table='person',
+    change_log_key='person_id'
+)
+
+GENRES_QUERIES = ExtractionQueries(
+    enrichers={'genre': None},
+    merger=GENRES_MERGER_QUERY,
+    state_prefix='genres:'
+)
@@ -0,0 +1,157 @@
+import logging
+from typing import Iterator, Optional
+
+from .elasticsearch_loader import ElasticsearchLoader
+from .postgres_extractor import PostgresExtractor
+from .transformer import Transformer
+
+
+class Reconciler:
+    """
+    Сверка индекса Elasticsearch с Postgres без переиндексации.
+    Id и версии документов читаются из обеих баз потоками,
+    отсортированными по id, и сливаются за один проход
+    в постоянной памяти. Загружаются только расхождения:
+    отсутствующие или устаревшие документы и документы,
+    которых уже нет в Postgres.
+    Документы для исправления читаются на подключении курсора сверки,
+    поэтому сверке хватает одного подключения из пула
+    """
+    def __init__(
+        self,
+        extractor: PostgresExtractor,
+        transformer: Transformer,
+        loader: ElasticsearchLoader,
+        logger: logging.Logger,
+        batch_size: int = 500,
+        page_size: int = 5000,
+        keep_alive: str = '5m'
+    ) -> None:
+        self.extractor = extractor
+        self.transformer = transformer
+        self.loader = loader
+        self.logger = logger
+        self.batch_size = batch_size
+        self.page_size = page_size
+        self.keep_alive = keep_alive
+
+    def postgres_versions(self, conn) -> Iterator[tuple[str, str]]:
+        """
+        Id и версии документов из Postgres через серверный курсор
+        Args:
+            conn: объект подключения к Postgres
+        Yields:
+            пары (id, версия) в порядке id
+        """
+        with self.extractor._cursor(conn, 'reconcile') as cursor:
+            cursor.execute(self.extractor.queries.reconcile)
+            for row in cursor:
+                yield row[0], row[1]
+
+    def elasticsearch_versions(self) -> Iterator[tuple[str, Optional[str]]]:
+        """
+        Id и версии документов из Elasticsearch постранично
+        через point in time и search_after
+        Yields:
+            пары (id, версия) в порядке id
+        """
+        es = self.loader.es
+        pit = es.open_point_in_time(
+            index=self.loader.index_name,
+            keep_alive=self.keep_alive
+        )['id']
+        try:
+            search_after = None
+            while True:
+                body = {
+                    'size': self.page_size,
+                    'pit': {'id': pit, 'keep_alive': self.keep_alive},
+                    'sort': [{'id': 'asc'}],
+                    '_source': ['version'],
+                    'track_total_hits': False
+                }
+                if search_after is not None:
+                    body['search_after'] = search_after
+                response = es.search(body=body)
+                pit = response.get('pit_id', pit)
+                hits = response['hits']['hits']
+                if not hits:
+                    return
+                for hit in hits:
+                    yield hit['_id'], hit['_source'].get('version')
+                search_after = hits[-1]['sort']
+        finally:
+            es.close_point_in_time(body={'id': pit})
+
+    @staticmethod
+    def merge_join(postgres: Iterator, elasticsearch: Iterator) -> Iterator[tuple[str, str]]:
+        """
+        Сливает два отсортированных по id потока версий
+        Args:
+            postgres: пары (id, версия) из Postgres
+            elasticsearch: пары (id, версия) из Elasticsearch
+        Yields:
+            ('upsert', id) для отсутствующих и устаревших документов,
+            ('delete', id) для документов, которых нет в Postgres
+        """
+        pg_item = next(postgres, None)
+        es_item = next(elasticsearch, None)
+        while pg_item is not None or es_item is not None:
+            if es_item is None or (pg_item is not None and pg_item[0] < es_item[0]):
+                yield 'upsert', pg_item[0]
+                pg_item = next(postgres, None)
+            elif pg_item is None or es_item[0] < pg_item[0]:
+                yield 'delete', es_item[0]
+                es_item = next(elasticsearch, None)
+            else:
+                if pg_item[1] != es_item[1]:
+                    yield 'upsert', pg_item[0]
+                pg_item = next(postgres, None)
+                es_item = next(elasticsearch, None)
+
+    def run(self) -> dict:
+        """
+        Сверяет индекс и загружает расхождения пачками
+        Returns:
+            число исправленных документов по типам расхождений
+        """
+        self.logger.info('Reconciliation of %s started', self.loader.index_name)
+        counts = {'upsert': 0, 'delete': 0}
+        ids = []
+        # хэши загруженных документов не отражают расхождений в индексе
+        skip_unchanged = self.loader.skip_unchanged
+        self.loader.skip_unchanged = False
+        try:
+            with self.extractor.connection.transaction() as conn:
+                differences = self.merge_join(
+                    self.postgres_versions(conn), self.elasticsearch_versions()
+                )
+                for op, id_ in differences:
+                    counts[op] += 1
+                    ids.append(id_)
+                    if len(ids) >= self.batch_size:
+                        self.fix(conn, ids)
+                        ids = []
+                if ids:
+                    self.fix(conn, ids)
+        finally:
+            self.loader.skip_unchanged = skip_unchanged
+
+        self.logger.info(
+            'Reconciliation of %s finished: %d upserted, %d deleted',
+            self.loader.index_name, counts['upsert'], counts['delete']
+        )
+        return counts
+
+    def fix(self, conn, ids: list[str]) -> None:
+        """
+        Загружает текущие версии документов, удалённые из Postgres
+        документы удаляются из индекса
+        Args:
+            conn: объект подключения курсора сверки
+            ids: id расходящихся документов
+        """
+        transformed_batch = self.transformer.transform(
+            self.extractor.extract_documents(ids, conn)
+        )
+        self.loader.load(transformed_batch)
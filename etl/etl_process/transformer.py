@@ -1,57 +1,145 @@
+from typing import NamedTuple
+
+
+class Deletion(NamedTuple):
+    """Строка пачки для фильма, удалённого в Postgres"""
+    id: str
+
+
 class Transformer:
     """
     Класс для трансформации данных из Postgres в ElasticSearch
     """
-    def __init__(self) -> None:
-        pass
-
-    def transform(self, batch: dict) -> list[dict]:
-        """
-        Функция для трансформации данных из Postgres в ElasticSearch
-        """
-        transformed_batch = []
-        for row in batch:
-            writers = []
-            actors = []
-            director = []
-            writers_names = []
-            actors_names = []
-
-            for person in row['persons']:
-                if person['person_role'] == 'director':
-                    director = person['person_name']
-                elif person['person_role'] == 'writer':
-                    writers_names.append(person['person_name'])
-                    writers.append(
-                        {
-                            'id': person['person_id'],
-                            'name': person['person_name']
-                        }
-                    )
-                elif person['person_role'] == 'actor':
-                    actors_names.append(person['person_name'])
-                    actors.append(
-                        {
-                            'id': person['person_id'],
-                            'name': person['person_name']
-                        }
-                    )
-
-            transformed_batch.append({
-                '_index': 'movies',
-                '_type': '_doc',
-                '_id': row['id'],
-                '_source': {
-                    'id': row['id'],
-                    'imdb_rating': row['rating'],
-                    'genre': row['genres'],
-                    'title': row['title'],
-                    'description': row['description'],
-                    'director': director,
-                    'actors_names': actors_names,
-                    'writers_names': writers_names,
-                    'actors': actors,
-                    'writers': writers
-                }
-            })
-        return transformed_batch
+    def __init__(self, raw_documents: bool = False) -> None:
+        self.raw_documents = raw_documents
+
+    def transform(self, batch: list) -> list:
+        """
+        Функция для трансформации данных из Postgres в ElasticSearch.
+        Удалённые фильмы превращаются в bulk-действия удаления
+        """
+        deletions = [
+            {'_op_type': 'delete', '_id': row.id}
+            for row in batch if isinstance(row, Deletion)
+        ]
+        rows = [row for row in batch if not isinstance(row, Deletion)]
+
+        if self.raw_documents:
+            return self.transform_raw(rows) + deletions
+
+        return [self.transform_row(row) for row in rows] + deletions
+
+    def transform_row(self, row) -> dict:
+        """
+        Превращает запись о фильме в bulk-действие индекса movies
+        Args:
+            row: запись из Postgres
+        Returns:
+            bulk-действие
+        """
+        writers = []
+        actors = []
+        director = []
+        writers_names = []
+        actors_names = []
+
+        for person in row['persons']:
+            if person['person_role'] == 'director':
+                director = person['person_name']
+            elif person['person_role'] == 'writer':
+                writers_names.append(person['person_name'])
+                writers.append(
+                    {
+                        'id': person['person_id'],
+                        'name': person['person_name']
+                    }
+                )
+            elif person['person_role'] == 'actor':
+                actors_names.append(person['person_name'])
+                actors.append(
+                    {
+                        'id': person['person_id'],
+                        'name': person['person_name']
+                    }
+                )
+
+        return {
+            '_type': '_doc',
+            '_id': row['id'],
+            '_source': {
+                'id': row['id'],
+                'imdb_rating': row['rating'],
+                'genre': row['genres'],
+                'title': row['title'],
+                'description': row['description'],
+                'director': director,
+                'actors_names': actors_names,
+                'writers_names': writers_names,
+                'actors': actors,
+                'writers': writers,
+                'version': row['version']
+            }
+        }
+
+    def transform_raw(self, batch: list) -> list[tuple]:
+        """
+        Функция для быстрого пути, когда документ собран в Postgres.
+        Документ остаётся готовой JSON-строкой и уходит в bulk без
+        повторной сериализации
+        Args:
+            batch: пары (id, json документа)
+        Returns:
+            пары (заголовок bulk-действия, json документа)
+        """
+        return [
+            ({'index': {'_id': film_id}}, document)
+            for film_id, document in batch
+        ]
+
+
+class PersonsTransformer(Transformer):
+    """
+    Трансформация персон для индекса persons
+    """
+    def transform_row(self, row) -> dict:
+        """
+        Превращает запись о персоне в bulk-действие индекса persons
+        Args:
+            row: запись из Postgres
+        Returns:
+            bulk-действие
+        """
+        return {
+            '_type': '_doc',
+            '_id': row['id'],
+            '_source': {
+                'id': row['id'],
+                'full_name': row['full_name'],
+                'actor_film_ids': row['actor_film_ids'],
+                'writer_film_ids': row['writer_film_ids'],
+                'director_film_ids': row['director_film_ids']
+            }
+        }
+
+
+class GenresTransformer(Transformer):
+    """
+    Трансформация жанров для индекса genres
+    """
+    def transform_row(self, row) -> dict:
+        """
+        Превращает запись о жанре в bulk-действие индекса genres
+        Args:
+            row: запись из Postgres
+        Returns:
+            bulk-действие
+        """
+        return {
+            '_type': '_doc',
+            '_id': row['id'],
+            '_source': {
+                'id': row['id'],
+                'name': row['name'],
+                'description': row['description']
+            }
+        }
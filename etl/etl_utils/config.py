@@ -152,6 +152,10 @@ class ESIndexConfig(BaseModel):
                         "analyzer": "ru_en"
                     }
                 }
+            },
+            "version": {
+                "type": "keyword",
+                "index": False
             }
         }
     }
@@ -159,6 +163,63 @@ class ESIndexConfig(BaseModel):
     index_name = 'movies'
 
 
+class PersonsIndexConfig(ESIndexConfig):
+    mappings = {
+        "dynamic": "strict",
+        "properties": {
+            "id": {
+                "type": "keyword"
+            },
+            "full_name": {
+                "type": "text",
+                "analyzer": "ru_en",
+                "fields": {
+                    "raw": {
+                        "type":  "keyword"
+                    }
+                }
+            },
+            "actor_film_ids": {
+                "type": "keyword"
+            },
+            "writer_film_ids": {
+                "type": "keyword"
+            },
+            "director_film_ids": {
+                "type": "keyword"
+            }
+        }
+    }
+
+    index_name = 'persons'
+
+
+class GenresIndexConfig(ESIndexConfig):
+    mappings = {
+        "dynamic": "strict",
+        "properties": {
+            "id": {
+                "type": "keyword"
+            },
+            "name": {
+                "type": "text",
+                "analyzer": "ru_en",
+                "fields": {
+                    "raw": {
+                        "type":  "keyword"
+                    }
+                }
+            },
+            "description": {
+                "type": "text",
+                "analyzer": "ru_en"
+            }
+        }
+    }
+
+    index_name = 'genres'
+
+
 class PostgresConfig(BaseSettings):
     dbname: str = Field('movies_database', env='POSTGRES_DB')
     user: str = Field('app', env='POSTGRES_USER')
@@ -183,5 +244,44 @@ class ETLServicesConfig(BaseSettings):
     postgres: dict = PostgresConfig().dict()
     elastic: str = ElasticConfig().get_url()
     index_config: ESIndexConfig = ESIndexConfig()
+    indexes: str = Field('movies,persons,genres', env='ES_INDEXES')
+    pg_pool_size: int = Field(5, env='PG_POOL_SIZE')
     sleep_time: int = Field(60, env='SLEEP_TIME')
     batch_size: int = Field(100, env='BATCH_SIZE')
+    adaptive_batch: bool = Field(False, env='ADAPTIVE_BATCH')
+    batch_size_min: int = Field(50, env='BATCH_SIZE_MIN')
+    batch_size_max: int = Field(5000, env='BATCH_SIZE_MAX')
+    batch_size_step: int = Field(100, env='BATCH_SIZE_STEP')
+    batch_size_decrease: float = Field(0.5, env='BATCH_SIZE_DECREASE')
+    bulk_target_latency: float = Field(1.0, env='BULK_TARGET_LATENCY')
+    bulk_target_bytes: int = Field(5 * 1024 * 1024, env='BULK_TARGET_BYTES')
+    itersize: int = Field(1000, env='ITERSIZE')
+    server_side_cursor: bool = Field(True, env='SERVER_SIDE_CURSOR')
+    state_storage: str = Field('file', env='STATE_STORAGE')
+    state_file_path: str = Field('state.json', env='STATE_FILE_PATH')
+    state_table: str = Field('public.etl_state', env='STATE_TABLE')
+    digest_storage: str = Field('none', env='DIGEST_STORAGE')
+    digest_file_path: str = Field('digests.sqlite', env='DIGEST_FILE_PATH')
+    digest_table: str = Field('public.etl_digest', env='DIGEST_TABLE')
+    dead_letter_storage: str = Field('ndjson', env='DEAD_LETTER_STORAGE')
+    dead_letter_file_path: str = Field('dead_letters.ndjson', env='DEAD_LETTER_FILE_PATH')
+    dead_letter_table: str = Field('public.etl_dead_letter', env='DEAD_LETTER_TABLE')
+    pipeline: bool = Field(False, env='PIPELINE')
+    engine: str = Field('threads', env='ETL_ENGINE')
+    reconcile_page_size: int = Field(5000, env='RECONCILE_PAGE_SIZE')
+    partitions: int = Field(1, env='ETL_PARTITIONS')
+    max_leases: int = Field(0, env='ETL_MAX_LEASES')
+    listen_notify: bool = Field(False, env='LISTEN_NOTIFY')
+    notify_debounce: float = Field(0.5, env='NOTIFY_DEBOUNCE')
+    notify_max_delay: float = Field(2.0, env='NOTIFY_MAX_DELAY')
+    raw_documents: bool = Field(False, env='RAW_DOCUMENTS')
+    extract_source: str = Field('modified', env='EXTRACT_SOURCE')
+    es_maxsize: int = Field(10, env='ES_MAXSIZE')
+    es_timeout: int = Field(30, env='ES_TIMEOUT')
+    bulk_thread_count: int = Field(1, env='BULK_THREAD_COUNT')
+    bulk_chunk_size: int = Field(500, env='BULK_CHUNK_SIZE')
+    bulk_max_chunk_bytes: int = Field(10 * 1024 * 1024, env='BULK_MAX_CHUNK_BYTES')
+    bulk_max_retries: int = Field(3, env='BULK_MAX_RETRIES')
+    queue_size: int = Field(4, env='QUEUE_SIZE')
+    metrics_port: int = Field(0, env='METRICS_PORT')
+    metrics_textfile: str = Field('', env='METRICS_TEXTFILE')
@@ -1,6 +1,8 @@
+import threading
 from contextlib import contextmanager
 
 import psycopg2
+import psycopg2.pool
 from elasticsearch import Elasticsearch
 
 from .config import get_logger
@@ -8,33 +10,147 @@ from .config import get_logger
 logger = get_logger(__name__)
 
 
-@contextmanager
-def pg_connection(dsn):
+def create_es_client(dsn: str, maxsize: int = 10, timeout: int = 30) -> Elasticsearch:
     """
-    Контекстный менеджер для подключения к Postgres
+    Создаёт долгоживущий клиент Elasticsearch с пулом HTTP-соединений.
+    Соединения пула переиспользуются (keep-alive) между запросами
     Args:
-        dsn: словарь с параметрами подключения
-    Yields:
-        conn: объект подключения к Postgres
+        dsn: строка с параметрами подключения
+        maxsize: размер пула соединений
+        timeout: таймаут запроса в секундах
+    Returns:
+        клиент Elasticsearch
     """
-    conn = psycopg2.connect(**dsn)
-    try:
-        yield conn
-    finally:
-        conn.close()
+    return Elasticsearch(
+        [dsn],
+        maxsize=maxsize,
+        timeout=timeout,
+        retry_on_timeout=True
+    )
 
 
-@contextmanager
-def es_connection(dsn):
+class PostgresConnection:
     """
-    Контекстный менеджер для подключения к Elasticsearch
-    Args:
-        dsn: строка с параметрами подключения
-    Yields:
-        conn: объект подключения к Elasticsearch
+    Долгоживущее подключение к Postgres.
+    Открывается при первом обращении, переиспользуется
+    между запусками ETL и переоткрывается после обрыва связи.
+    Подключение может быть общим для нескольких потоков,
+    поэтому транзакции на нём выполняются по очереди под блокировкой
     """
-    conn = Elasticsearch([dsn])
-    try:
-        yield conn
-    finally:
-        conn.close()
+    def __init__(self, dsn: dict) -> None:
+        self.dsn = dsn
+        self.conn = None
+        self.lock = threading.RLock()
+
+    def connect(self):
+        """
+        Возвращает открытое подключение, при необходимости переподключаясь
+        Returns:
+            conn: объект подключения к Postgres
+        """
+        with self.lock:
+            if self.conn is None or self.conn.closed:
+                self.conn = psycopg2.connect(**self.dsn)
+                logger.info('Postgres connection opened')
+            return self.conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        Контекстный менеджер транзакции на долгоживущем подключении.
+        Транзакция фиксируется при успешном выходе и откатывается при ошибке,
+        сломанное подключение закрывается
+        Yields:
+            conn: объект подключения к Postgres
+        """
+        with self.lock:
+            conn = self.connect()
+            try:
+                yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self.close()
+                raise
+            except BaseException:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    self.close()
+                raise
+            else:
+                conn.commit()
+
+    def close(self) -> None:
+        """Закрывает подключение"""
+        with self.lock:
+            if self.conn is not None and not self.conn.closed:
+                self.conn.close()
+                logger.info('Postgres connection closed')
+            self.conn = None
+
+
+class PostgresConnectionPool:
+    """
+    Общий пул подключений к Postgres для нескольких потоков ETL.
+    Каждая транзакция берёт подключение из пула и возвращает его,
+    сломанные подключения закрываются пулом
+    """
+    def __init__(self, dsn: dict, maxconn: int = 5) -> None:
+        self.dsn = dsn
+        self.maxconn = maxconn
+        self.pool = None
+        # потоки индексов могут впервые обратиться к пулу одновременно
+        self.lock = threading.Lock()
+
+    def connect(self) -> psycopg2.pool.ThreadedConnectionPool:
+        """
+        Возвращает пул, создавая его при первом обращении
+        Returns:
+            пул подключений к Postgres
+        """
+        with self.lock:
+            if self.pool is None or self.pool.closed:
+                self.pool = psycopg2.pool.ThreadedConnectionPool(0, self.maxconn, **self.dsn)
+                logger.info('Postgres connection pool opened, max %d connections', self.maxconn)
+            return self.pool
+
+    @contextmanager
+    def transaction(self):
+        """
+        Контекстный менеджер транзакции на подключении из пула.
+        Транзакция фиксируется при успешном выходе и откатывается при ошибке,
+        сломанное подключение не возвращается в оборот
+        Yields:
+            conn: объект подключения к Postgres
+        """
+        pool = self.connect()
+        conn = pool.getconn()
+        broken = False
+        try:
+            if conn.closed:
+                raise psycopg2.InterfaceError('connection already closed')
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        except BaseException:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+            raise
+        else:
+            try:
+                conn.commit()
+            except psycopg2.Error:
+                broken = True
+                raise
+        finally:
+            pool.putconn(conn, close=broken or bool(conn.closed))
+
+    def close(self) -> None:
+        """Закрывает все подключения пула"""
+        with self.lock:
+            if self.pool is not None and not self.pool.closed:
+                self.pool.closeall()
+                logger.info('Postgres connection pool closed')
+            self.pool = None
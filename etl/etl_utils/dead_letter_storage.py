@@ -0,0 +1,190 @@
+import abc
+import json
+import os
+import threading
+import uuid
+
+import psycopg2.extras
+
+from .backoff import backoff
+from .connection_config import PostgresConnection
+
+
+class BaseDeadLetterStorage:
+    """
+    Хранилище документов, которые не удалось загрузить в Elasticsearch.
+    Запись - словарь с полями index, doc_id, op_type, header, source,
+    status, error и watermark пачки, в которой документ не загрузился
+    """
+    @abc.abstractmethod
+    def save_letters(self, letters: list[dict]) -> None:
+        """Сохранить незагруженные документы"""
+        pass
+
+    @abc.abstractmethod
+    def retrieve_letters(self, index: str) -> list[dict]:
+        """Загрузить незагруженные документы индекса вместе с ключами записей"""
+        pass
+
+    @abc.abstractmethod
+    def delete_letters(self, keys: list[str]) -> None:
+        """Удалить записи по ключам"""
+        pass
+
+
+class NDJSONDeadLetterStorage(BaseDeadLetterStorage):
+    """
+    Реализация хранилища незагруженных документов в локальном файле NDJSON.
+    Новые записи дописываются в конец файла, при удалении файл
+    атомарно переписывается без удалённых записей
+    """
+    def __init__(self, file_path: str = 'dead_letters.ndjson') -> None:
+        self.file_path = file_path
+        self.lock = threading.Lock()
+
+    def save_letters(self, letters: list[dict]) -> None:
+        """
+        Дописать незагруженные документы в файл
+        Args:
+            letters: записи о незагруженных документах
+        """
+        if not letters:
+            return
+        with self.lock, open(self.file_path, 'a', encoding='utf-8') as file:
+            for letter in letters:
+                letter = dict(letter, key=uuid.uuid4().hex)
+                file.write(json.dumps(letter, ensure_ascii=False, default=str) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _read(self) -> list[dict]:
+        """Прочитать все записи файла"""
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as file:
+                return [json.loads(line) for line in file if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def retrieve_letters(self, index: str) -> list[dict]:
+        """
+        Загрузить незагруженные документы индекса
+        Args:
+            index: имя индекса
+        Returns:
+            записи в порядке сохранения
+        """
+        with self.lock:
+            return [letter for letter in self._read() if letter['index'] == index]
+
+    def delete_letters(self, keys: list[str]) -> None:
+        """
+        Удалить записи по ключам
+        Args:
+            keys: ключи записей
+        """
+        keys = set(keys)
+        if not keys:
+            return
+        with self.lock:
+            letters = [letter for letter in self._read() if letter['key'] not in keys]
+            tmp_path = f'{self.file_path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                for letter in letters:
+                    file.write(json.dumps(letter, ensure_ascii=False) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.file_path)
+
+
+class PostgresDeadLetterStorage(BaseDeadLetterStorage):
+    """
+    Реализация хранилища незагруженных документов в таблице Postgres
+    """
+    def __init__(self, dsn: dict, table: str = 'public.etl_dead_letter') -> None:
+        self.table = table
+        self.connection = PostgresConnection(dsn)
+        self.lock = threading.Lock()
+        self.create_table()
+
+    @backoff()
+    def create_table(self) -> None:
+        """Создать таблицу незагруженных документов, если её ещё нет"""
+        with self.connection.transaction() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                    'key BIGSERIAL PRIMARY KEY, '
+                    'index TEXT NOT NULL, '
+                    'doc_id TEXT, '
+                    'op_type TEXT NOT NULL, '
+                    'header JSONB NOT NULL, '
+                    'source TEXT, '
+                    'status TEXT, '
+                    'error TEXT, '
+                    'watermark JSONB, '
+                    'failed_at TIMESTAMP WITH TIME ZONE DEFAULT now())'
+                )
+
+    @backoff()
+    def save_letters(self, letters: list[dict]) -> None:
+        """
+        Сохранить незагруженные документы
+        Args:
+            letters: записи о незагруженных документах
+        """
+        if not letters:
+            return
+        with self.lock, self.connection.transaction() as conn:
+            with conn.cursor() as cursor:
+                psycopg2.extras.execute_values(
+                    cursor,
+                    f'INSERT INTO {self.table} '
+                    '(index, doc_id, op_type, header, source, status, error, watermark) '
+                    'VALUES %s',
+                    [
+                        (
+                            letter['index'],
+                            letter['doc_id'],
+                            letter['op_type'],
+                            psycopg2.extras.Json(letter['header']),
+                            letter['source'],
+                            letter['status'],
+                            letter['error'],
+                            psycopg2.extras.Json(letter['watermark'])
+                        )
+                        for letter in letters
+                    ]
+                )
+
+    def retrieve_letters(self, index: str) -> list[dict]:
+        """
+        Загрузить незагруженные документы индекса
+        Args:
+            index: имя индекса
+        Returns:
+            записи в порядке сохранения
+        """
+        with self.lock, self.connection.transaction() as conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                cursor.execute(
+                    'SELECT key::text, index, doc_id, op_type, header, source, '
+                    'status, error, watermark, failed_at '
+                    f'FROM {self.table} WHERE index = %s ORDER BY key',
+                    (index,)
+                )
+                return [dict(row) for row in cursor.fetchall()]
+
+    def delete_letters(self, keys: list[str]) -> None:
+        """
+        Удалить записи по ключам
+        Args:
+            keys: ключи записей
+        """
+        if not keys:
+            return
+        with self.lock, self.connection.transaction() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f'DELETE FROM {self.table} WHERE key = ANY(%s::bigint[])',
+                    (list(keys),)
+                )
@@ -0,0 +1,156 @@
+import abc
+import hashlib
+import json
+import sqlite3
+
+import psycopg2.extras
+
+from .backoff import backoff
+from .connection_config import PostgresConnection
+
+
+def document_digest(source) -> str:
+    """
+    Стабильный хэш _source документа.
+    Готовая JSON-строка хэшируется как есть,
+    словарь сериализуется с сортировкой ключей
+    Args:
+        source: _source документа, словарь или JSON-строка
+    Returns:
+        hex-строка хэша
+    """
+    if not isinstance(source, str):
+        source = json.dumps(source, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+class BaseDigestStorage:
+    @abc.abstractmethod
+    def retrieve_digests(self, ids: list[str]) -> dict:
+        """Загрузить хэши документов по id"""
+        pass
+
+    @abc.abstractmethod
+    def save_digests(self, digests: dict) -> None:
+        """Сохранить хэши документов"""
+        pass
+
+    @abc.abstractmethod
+    def delete_digests(self, ids: list[str]) -> None:
+        """Удалить хэши документов"""
+        pass
+
+
+class SQLiteDigestStorage(BaseDigestStorage):
+    """
+    Реализация хранилища хэшей документов в локальном файле SQLite
+    """
+    def __init__(self, file_path: str = 'digests.sqlite') -> None:
+        self.conn = sqlite3.connect(file_path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS digests '
+            '(id TEXT PRIMARY KEY, digest TEXT NOT NULL)'
+        )
+        self.conn.commit()
+
+    def retrieve_digests(self, ids: list[str]) -> dict:
+        """
+        Загрузить хэши документов по id
+        Args:
+            ids: id документов
+        Returns:
+            словарь id -> хэш
+        """
+        if not ids:
+            return {}
+        cursor = self.conn.execute(
+            f'SELECT id, digest FROM digests WHERE id IN ({",".join("?" * len(ids))})',
+            ids
+        )
+        return dict(cursor.fetchall())
+
+    def save_digests(self, digests: dict) -> None:
+        """
+        Сохранить хэши документов
+        Args:
+            digests: словарь id -> хэш
+        """
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO digests (id, digest) VALUES (?, ?)',
+            digests.items()
+        )
+        self.conn.commit()
+
+    def delete_digests(self, ids: list[str]) -> None:
+        """
+        Удалить хэши документов
+        Args:
+            ids: id документов
+        """
+        self.conn.executemany('DELETE FROM digests WHERE id = ?', [(id_,) for id_ in ids])
+        self.conn.commit()
+
+
+class PostgresDigestStorage(BaseDigestStorage):
+    """
+    Реализация хранилища хэшей документов в таблице Postgres
+    """
+    def __init__(self, dsn: dict, table: str = 'public.etl_digest') -> None:
+        self.table = table
+        self.connection = PostgresConnection(dsn)
+        self.create_table()
+
+    @backoff()
+    def create_table(self) -> None:
+        """Создать таблицу хэшей, если её ещё нет"""
+        with self.connection.transaction() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                    'id TEXT PRIMARY KEY, '
+                    'digest TEXT NOT NULL)'
+                )
+
+    def retrieve_digests(self, ids: list[str]) -> dict:
+        """
+        Загрузить хэши документов по id
+        Args:
+            ids: id документов
+        Returns:
+            словарь id -> хэш
+        """
+        with self.connection.transaction() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f'SELECT id, digest FROM {self.table} WHERE id = ANY(%s)',
+                    (list(ids),)
+                )
+                return dict(cursor.fetchall())
+
+    def save_digests(self, digests: dict) -> None:
+        """
+        Сохранить хэши документов
+        Args:
+            digests: словарь id -> хэш
+        """
+        with self.connection.transaction() as conn:
+            with conn.cursor() as cursor:
+                psycopg2.extras.execute_values(
+                    cursor,
+                    f'INSERT INTO {self.table} (id, digest) VALUES %s '
+                    'ON CONFLICT (id) DO UPDATE SET digest = EXCLUDED.digest',
+                    list(digests.items())
+                )
+
+    def delete_digests(self, ids: list[str]) -> None:
+        """
+        Удалить хэши документов
+        Args:
+            ids: id документов
+        """
+        with self.connection.transaction() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f'DELETE FROM {self.table} WHERE id = ANY(%s)',
+                    (list(ids),)
+                )
@@ -0,0 +1,136 @@
+import logging
+import math
+import random
+
+import psycopg2
+
+from .connection_config import PostgresConnection
+
+# Первый ключ pg_advisory_lock, общий для всех партиций ETL
+LOCK_CLASS = 7311
+
+# Первый ключ pg_advisory_lock, которым воркер отмечает, что он жив
+WORKER_CLASS = 7312
+
+# Advisory-локи с двумя ключами текущей базы по первому ключу
+ADVISORY_LOCKS_QUERY = """
+    SELECT objid::bigint
+    FROM pg_locks
+    WHERE locktype = 'advisory'
+      AND database = (SELECT oid FROM pg_database WHERE datname = current_database())
+      AND classid = %s
+      AND objsubid = 2
+      AND granted
+"""
+
+
+class PartitionLeases:
+    """
+    Аренда партиций фильмов через сессионные advisory-локи Postgres.
+    Лок держится, пока живо подключение воркера, поэтому партиции
+    упавшего воркера освобождаются сами и достаются остальным.
+    Каждый воркер держит свою долю партиций от числа живых воркеров:
+    лишние партиции отпускаются для новых воркеров, а партиции,
+    оставшиеся без владельца, забираются сверх max_leases
+    """
+    def __init__(
+        self,
+        dsn: dict,
+        partitions: int,
+        max_leases: int,
+        logger: logging.Logger
+    ) -> None:
+        self.connection = PostgresConnection(dsn)
+        self.partitions = partitions
+        # 0 - без ограничения, только доля от числа воркеров
+        self.max_leases = max_leases
+        self.logger = logger
+        self.held = set()
+        # партиции без владельца при прошлой аренде
+        self.orphaned = set()
+        self.lock_conn = None
+
+    def claim(self) -> list[int]:
+        """
+        Перераспределяет партиции по числу живых воркеров.
+        Партиции сверх доли отпускаются, свободные арендуются
+        до доли, но не больше max_leases. Партиции, свободные
+        и при прошлой аренде, забираются до доли и сверх max_leases,
+        чтобы партиции упавшего воркера не остались без владельца.
+        Перебор начинается со случайной партиции, чтобы воркеры
+        не соревновались за одни и те же
+        Returns:
+            отсортированный список арендованных партиций
+        """
+        try:
+            with self.connection.transaction() as conn, conn.cursor() as cursor:
+                if conn is not self.lock_conn:
+                    if self.held:
+                        self.logger.warning('Lost leases of partitions %s', sorted(self.held))
+                    self.held = set()
+                    self.orphaned = set()
+                    self.lock_conn = conn
+                    cursor.execute(
+                        'SELECT pg_advisory_lock(%s, pg_backend_pid())',
+                        (WORKER_CLASS,)
+                    )
+
+                cursor.execute(ADVISORY_LOCKS_QUERY, (WORKER_CLASS,))
+                workers = max(len(cursor.fetchall()), 1)
+                share = math.ceil(self.partitions / workers)
+                limit = min(share, self.max_leases) if self.max_leases else share
+
+                released = sorted(self.held)[share:]
+                for partition in released:
+                    cursor.execute(
+                        'SELECT pg_advisory_unlock(%s, %s)',
+                        (LOCK_CLASS, partition)
+                    )
+                    self.held.discard(partition)
+                if released:
+                    self.logger.info(
+                        'Partitions %s released, fair share of %d workers is %d',
+                        released, workers, share
+                    )
+
+                cursor.execute(ADVISORY_LOCKS_QUERY, (LOCK_CLASS,))
+                leased = {row[0] for row in cursor.fetchall()}
+                start = random.randrange(self.partitions)
+                free = [
+                    partition
+                    for partition in (
+                        (start + shift) % self.partitions
+                        for shift in range(self.partitions)
+                    )
+                    if partition not in leased and partition not in released
+                ]
+
+                orphaned = self.orphaned
+                for partition in free:
+                    if partition in orphaned:
+                        if len(self.held) >= share:
+                            continue
+                    elif len(self.held) >= limit:
+                        continue
+                    cursor.execute(
+                        'SELECT pg_try_advisory_lock(%s, %s)',
+                        (LOCK_CLASS, partition)
+                    )
+                    if cursor.fetchone()[0]:
+                        self.held.add(partition)
+                        self.logger.info('Partition %d leased', partition)
+                self.orphaned = set(free) - self.held
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.logger.exception('Lease connection lost')
+            self.held = set()
+            self.orphaned = set()
+            self.lock_conn = None
+
+        return sorted(self.held)
+
+    def release(self) -> None:
+        """Освобождает все арендованные партиции и отметку воркера"""
+        self.connection.close()
+        self.held = set()
+        self.orphaned = set()
+        self.lock_conn = None
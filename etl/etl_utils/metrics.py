@@ -0,0 +1,187 @@
+import time
+from datetime import datetime, timezone
+from typing import AsyncIterator, Iterator, Optional
+
+from prometheus_client import (REGISTRY, Counter, Gauge, Histogram,
+                               start_http_server, write_to_textfile)
+
+# Метрики ETL. Скорости строк и байт считаются в Prometheus
+# через rate() по счётчикам, отставание - по самому старому
+# незагруженному изменению и по watermark'ам пачек во время прохода
+
+STAGE_SECONDS = Histogram(
+    'etl_stage_duration_seconds',
+    'Time spent by a stage on one batch',
+    ['index', 'stage'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+ROWS = Counter(
+    'etl_rows_total',
+    'Rows processed by a stage',
+    ['index', 'stage']
+)
+BYTES = Counter(
+    'etl_bytes_total',
+    'Estimated bytes of documents sent to Elasticsearch',
+    ['index']
+)
+BATCH_ROWS = Histogram(
+    'etl_batch_rows',
+    'Rows in an extracted batch',
+    ['index'],
+    buckets=(0, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+)
+BATCH_SIZE = Gauge(
+    'etl_batch_size',
+    'Current extraction batch size',
+    ['index']
+)
+RETRIES = Counter(
+    'etl_retries_total',
+    'Retries of a stage after transient errors',
+    ['index', 'stage']
+)
+DOCUMENTS_RETRIED = Counter(
+    'etl_documents_retried_total',
+    'Documents resent to Elasticsearch after 429 rejections',
+    ['index']
+)
+FAILED = Counter(
+    'etl_documents_failed_total',
+    'Documents Elasticsearch did not index',
+    ['index']
+)
+WRITES_AVOIDED = Counter(
+    'etl_writes_avoided_total',
+    'Unchanged documents that were not sent to Elasticsearch',
+    ['index']
+)
+QUEUE_DEPTH = Gauge(
+    'etl_queue_depth',
+    'Batches waiting between pipeline stages',
+    ['index', 'queue']
+)
+WATERMARK = Gauge(
+    'etl_watermark_timestamp_seconds',
+    'Modified timestamp of the last loaded batch',
+    ['index', 'key']
+)
+LAG = Gauge(
+    'etl_lag_seconds',
+    'Seconds between now and the oldest change not loaded yet, '
+    '0 when nothing is pending',
+    ['index']
+)
+
+
+def track_batches(index: str, extractor, batches: Iterator) -> Iterator[tuple[list, dict]]:
+    """
+    Учитывает время извлечения каждой пачки и её размер
+    Args:
+        index: имя индекса
+        extractor: экстрактор, из которого берётся текущий размер пачки
+        batches: пачки из extractor.extract()
+    Yields:
+        те же пачки
+    """
+    started = time.monotonic()
+    for batch, checkpoint in batches:
+        observe_extract(index, extractor.batch_size, batch, time.monotonic() - started)
+        yield batch, checkpoint
+        started = time.monotonic()
+
+
+async def track_async_batches(
+    index: str,
+    extractor,
+    batches: AsyncIterator
+) -> AsyncIterator[tuple[list, dict]]:
+    """Асинхронный вариант track_batches"""
+    started = time.monotonic()
+    async for batch, checkpoint in batches:
+        observe_extract(index, extractor.batch_size, batch, time.monotonic() - started)
+        yield batch, checkpoint
+        started = time.monotonic()
+
+
+def observe_extract(index: str, batch_size: int, batch: list, seconds: float) -> None:
+    """Учитывает извлечённую пачку"""
+    STAGE_SECONDS.labels(index, 'extract').observe(seconds)
+    ROWS.labels(index, 'extract').inc(len(batch))
+    BATCH_ROWS.labels(index).observe(len(batch))
+    BATCH_SIZE.labels(index).set(batch_size)
+
+
+def observe_stage(index: str, stage: str, rows: int, seconds: float) -> None:
+    """
+    Учитывает обработку пачки стадией
+    Args:
+        index: имя индекса
+        stage: стадия: transform или load
+        rows: число документов
+        seconds: время обработки
+    """
+    STAGE_SECONDS.labels(index, stage).observe(seconds)
+    ROWS.labels(index, stage).inc(rows)
+
+
+def observe_checkpoint(index: str, checkpoint: dict) -> None:
+    """
+    Обновляет watermark и отставание индекса по сохранённым состояниям пачки
+    Args:
+        index: имя индекса
+        checkpoint: словарь состояний пачки
+    """
+    newest = None
+    for key, value in checkpoint.items():
+        if isinstance(value, dict) and 'modified' in value:
+            modified = datetime.fromisoformat(value['modified']).timestamp()
+            WATERMARK.labels(index, key).set(modified)
+            newest = modified if newest is None else max(newest, modified)
+    if newest is None:
+        return
+    LAG.labels(index).set(max(0.0, datetime.now(timezone.utc).timestamp() - newest))
+
+
+def observe_pending(index: str, oldest: Optional[datetime]) -> None:
+    """
+    Обновляет отставание индекса после прохода
+    Args:
+        index: имя индекса
+        oldest: время самого старого незагруженного изменения или None
+    """
+    if oldest is None:
+        LAG.labels(index).set(0)
+        return
+    LAG.labels(index).set(max(0.0, datetime.now(timezone.utc).timestamp() - oldest.timestamp()))
+
+
+def observe_queues(index: str, queues: dict) -> None:
+    """
+    Обновляет глубину очередей конвейера
+    Args:
+        index: имя индекса
+        queues: очереди по именам стадий, которые из них читают
+    """
+    for name, queue in queues.items():
+        QUEUE_DEPTH.labels(index, name).set(queue.qsize())
+
+
+def start_exporter(port: int) -> None:
+    """
+    Открывает HTTP-эндпоинт Prometheus в фоновом потоке
+    Args:
+        port: порт эндпоинта, 0 - не открывать
+    """
+    if port:
+        start_http_server(port)
+
+
+def write_textfile(textfile: Optional[str]) -> None:
+    """
+    Записывает метрики в файл для textfile collector node_exporter
+    Args:
+        textfile: путь к файлу .prom или None
+    """
+    if textfile:
+        write_to_textfile(textfile, REGISTRY)
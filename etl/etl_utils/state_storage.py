@@ -1,7 +1,14 @@
 import abc
 import json
+import os
+import threading
 from typing import Any, Optional
 
+import psycopg2.extras
+
+from .backoff import backoff
+from .connection_config import PostgresConnection
+
 
 class BaseStorage:
     @abc.abstractmethod
@@ -14,6 +21,13 @@ class BaseStorage:
         """Загрузить состояние локально из постоянного хранилища"""
         pass
 
+    def save_keys(self, state: dict, keys: set) -> None:
+        """
+        Сохранить изменённые ключи состояния.
+        По умолчанию сохраняется всё состояние целиком
+        """
+        self.save_state(state)
+
 
 class JsonFileStorage(BaseStorage):
     """
@@ -24,21 +38,28 @@ class JsonFileStorage(BaseStorage):
 
     def save_state(self, state: dict) -> None:
         """
-        Сохранить состояние в файл
+        Атомарно сохранить состояние в файл:
+        запись во временный файл, fsync и переименование,
+        поэтому при падении на диске остаётся старая или новая версия
         Args:
             state: Словарь с состоянием
         Returns:
             None
         """
+        tmp_path = f'{self.file_path}.tmp'
+
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(state, file)
+            file.flush()
+            os.fsync(file.fileno())
 
-        base_state = self.retrieve_state()
-        base_state.update(state)
+        os.replace(tmp_path, self.file_path)
 
-        with open(self.file_path, 'w', encoding='utf-8') as file:
-            json.dump(
-                base_state,
-                file
-            )
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.file_path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
     def retrieve_state(self) -> dict:
         """
@@ -50,23 +71,107 @@ class JsonFileStorage(BaseStorage):
             with open(self.file_path, 'r', encoding='utf-8') as file:
                 return json.load(file)
         except (FileNotFoundError):
-            return {
-                'last_etl_process_time': '1970-01-01 00:00:00.000000+00',
-                'previous_extracted_ids': []
-            }
+            return {}
+
+
+class MemoryStorage(BaseStorage):
+    """
+    Хранилище состояния в памяти процесса,
+    например для разовой полной переиндексации
+    """
+    def __init__(self) -> None:
+        self.state = {}
+
+    def save_state(self, state: dict) -> None:
+        """Сохранить состояние в памяти"""
+        self.state = dict(state)
+
+    def retrieve_state(self) -> dict:
+        """Загрузить состояние из памяти"""
+        return dict(self.state)
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Реализация хранилища состояния в таблице Postgres,
+    состояние переживает пересборку контейнера ETL
+    """
+    def __init__(self, dsn: dict, table: str = 'public.etl_state') -> None:
+        self.dsn = dsn
+        self.table = table
+        self.connection = PostgresConnection(dsn)
+        self.create_table()
+
+    @backoff()
+    def create_table(self) -> None:
+        """Создать таблицу состояния, если её ещё нет"""
+        with self.connection.transaction() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                    'key TEXT PRIMARY KEY, '
+                    'value JSONB, '
+                    'modified TIMESTAMP WITH TIME ZONE DEFAULT now())'
+                )
+
+    @backoff()
+    def save_state(self, state: dict) -> None:
+        """
+        Сохранить состояние одной транзакцией
+        Args:
+            state: Словарь с состоянием
+        Returns:
+            None
+        """
+        with self.connection.transaction() as conn:
+            with conn.cursor() as cursor:
+                psycopg2.extras.execute_values(
+                    cursor,
+                    f'INSERT INTO {self.table} (key, value) VALUES %s '
+                    'ON CONFLICT (key) DO UPDATE '
+                    'SET value = EXCLUDED.value, modified = now()',
+                    [(key, psycopg2.extras.Json(value)) for key, value in state.items()]
+                )
+
+    def save_keys(self, state: dict, keys: set) -> None:
+        """
+        Сохранить только изменённые ключи, чтобы не затереть
+        состояние, которое пишут другие воркеры
+        Args:
+            state: Словарь с состоянием
+            keys: изменённые ключи
+        Returns:
+            None
+        """
+        self.save_state({key: state[key] for key in keys})
+
+    def retrieve_state(self) -> dict:
+        """
+        Загрузить состояние из таблицы
+        Returns:
+            Словарь с состоянием
+        """
+        with self.connection.transaction() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(f'SELECT key, value FROM {self.table}')
+                return dict(cursor.fetchall())
 
 
 class State:
     """
     Класс для хранения состояния при работе с данными,
     чтобы постоянно не перечитывать данные с начала.
-    Здесь представлена реализация с сохранением состояния в файл.
-    В целом ничего не мешает поменять это поведение
-    на работу с БД или распределённым хранилищем.
+    Состояние держится в памяти и попадает в хранилище
+    только при явном вызове checkpoint.
+    Состояние общее для пайплайнов всех индексов,
+    поэтому изменения и сохранение выполняются под блокировкой
     """
 
     def __init__(self, storage: BaseStorage) -> None:
         self.storage = storage
+        self.state = storage.retrieve_state()
+        self.dirty = set()
+        self.lock = threading.RLock()
 
     def set_state(self, key: str, value: Any) -> None:
         """
@@ -77,9 +182,9 @@ class State:
         Returns:
             None
         """
-        data = self.storage.retrieve_state()
-        data[key] = value
-        self.storage.save_state(data)
+        with self.lock:
+            self.state[key] = value
+            self.dirty.add(key)
 
     def get_state(self, key: str) -> Any:
         """
@@ -89,4 +194,52 @@ class State:
         Returns:
             Значение
         """
-        return self.storage.retrieve_state().get(key)
+        return self.state.get(key)
+
+    def checkpoint(self) -> None:
+        """
+        Сохранить накопленные изменения состояния в хранилище
+        Returns:
+            None
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+
+            self.storage.save_keys(self.state, self.dirty)
+            self.dirty = set()
+
+    def stored(self) -> dict:
+        """
+        Прочитать состояние, сохранённое в хранилище, не меняя
+        состояние в памяти. Чтение идёт под блокировкой,
+        чтобы не пересечься с сохранением из другого потока
+        Returns:
+            Словарь с сохранённым состоянием
+        """
+        with self.lock:
+            return self.storage.retrieve_state()
+
+    def reload(self) -> None:
+        """
+        Перечитать состояние из хранилища, например когда
+        другой воркер мог изменить его, сохранив свои изменения
+        Returns:
+            None
+        """
+        with self.lock:
+            self.checkpoint()
+            self.state = self.storage.retrieve_state()
+
+    def commit(self, values: dict) -> None:
+        """
+        Установить несколько состояний и сразу сохранить их в хранилище
+        Args:
+            values: Словарь ключ -> значение
+        Returns:
+            None
+        """
+        with self.lock:
+            for key, value in values.items():
+                self.set_state(key, value)
+            self.checkpoint()
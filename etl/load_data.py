@@ -1,16 +1,34 @@
-import datetime
+import argparse
+import asyncio
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
+from etl_process.batch_controller import BatchSizeController
+from etl_process.bulk_indexer import BulkIndexer
+from etl_process.change_listener import ChangeListener
 from etl_process.elasticsearch_loader import ElasticsearchLoader
-from etl_process.postgres_extractor import PostgresExtractor
+from etl_process.indexes import INDEXES, IndexPipeline
+from etl_process.pipeline import Pipeline
+from etl_process.postgres_extractor import (PostgresExtractor,
+                                           partition_state_key)
+from etl_process.reconciler import Reconciler
 from etl_process.transformer import Transformer
+from etl_utils import metrics
 from etl_utils.backoff import backoff
 from etl_utils.config import ETLServicesConfig, get_logger
-from etl_utils.state_storage import JsonFileStorage, State
+from etl_utils.connection_config import PostgresConnectionPool
+from etl_utils.dead_letter_storage import (BaseDeadLetterStorage,
+                                           NDJSONDeadLetterStorage,
+                                           PostgresDeadLetterStorage)
+from etl_utils.digest_storage import (BaseDigestStorage, PostgresDigestStorage,
+                                      SQLiteDigestStorage)
+from etl_utils.leases import PartitionLeases
+from etl_utils.state_storage import (BaseStorage, JsonFileStorage,
+                                     MemoryStorage, PostgresStorage, State)
 
 
-@backoff()
 def etl_process(
     extractor: PostgresExtractor,
     transformer: Transformer,
@@ -20,52 +38,554 @@ def etl_process(
 ):
     """
     Функция для запуска ETL процесса для
-    загрузки данных из Postgres в ElasticSearch
+    загрузки данных из Postgres в ElasticSearch.
+    Повторы выполняются внутри стадий для одной пачки,
+    а состояние сохраняется после каждой загруженной пачки,
+    поэтому повторный запуск продолжает с последней сохранённой пачки
     """
     logger.info('ETL process started')
+    index = loader.index_name
 
-    last_etl_process_time = state.get_state('last_etl_process_time')
-    logger.info('Last ETL process time: %s', last_etl_process_time)
-
-    for i, batch in enumerate(extractor.extract(last_etl_process_time)):
-        logger.info(f'Extracted %d batch', i+1)
+    batches = metrics.track_batches(index, extractor, extractor.extract())
+    for i, (batch, checkpoint) in enumerate(batches):
+        logger.info('Extracted %d batch', i+1)
+        started = time.monotonic()
         transformed_batch = transformer.transform(batch)
-        logger.info(f'Transformed %d batch', i+1)
-        loader.load(transformed_batch)
-        logger.info(f'Loaded %d batch', i+1)
+        metrics.observe_stage(index, 'transform', len(batch), time.monotonic() - started)
+        logger.info('Transformed %d batch', i+1)
+        if transformed_batch:
+            loader.load(transformed_batch, checkpoint)
+        logger.info('Loaded %d batch', i+1)
+        state.commit(checkpoint)
+        metrics.observe_checkpoint(index, checkpoint)
+
+    # при работе по партициям отставание считает run_partitions
+    if extractor.partition is None:
+        metrics.observe_pending(index, extractor.oldest_pending())
+    logger.info('ETL process finished')
+
+
+def pipelined_etl_process(pipeline: Pipeline, logger: logging.Logger):
+    """
+    Функция для запуска конвейерного ETL процесса,
+    в котором стадии работают одновременно
+    """
+    logger.info('ETL pipeline started')
+    pipeline.run()
+    logger.info('ETL pipeline finished')
 
-    state.set_state(
-        'last_etl_process_time',
-        datetime.datetime.now().isoformat()
+
+def run_etl(
+    config: ETLServicesConfig,
+    extractor: PostgresExtractor,
+    transformer: Transformer,
+    loader: ElasticsearchLoader,
+    state: State,
+    logger: logging.Logger
+):
+    """
+    Функция для одного прохода ETL в режиме из конфигурации
+    """
+    if config.pipeline:
+        pipeline = Pipeline(
+            extractor,
+            transformer,
+            loader,
+            state,
+            logger,
+            queue_size=config.queue_size
+        )
+        pipelined_etl_process(pipeline, logger)
+    else:
+        etl_process(extractor, transformer, loader, state, logger)
+
+
+def run_partitions(
+    config: ETLServicesConfig,
+    partitions: list[int],
+    extractor: PostgresExtractor,
+    transformer: Transformer,
+    loader: ElasticsearchLoader,
+    state: State,
+    logger: logging.Logger
+):
+    """
+    Функция для прохода ETL по арендованным партициям фильмов.
+    Каждая партиция загружается со своими watermark'ами
+    """
+    oldest = []
+    for partition in partitions:
+        logger.info('Processing partition %d of %d', partition, config.partitions)
+        extractor.partition = (partition, config.partitions)
+        try:
+            run_etl(config, extractor, transformer, loader, state, logger)
+            oldest.append(extractor.oldest_pending())
+        finally:
+            extractor.partition = None
+    metrics.observe_pending(
+        loader.index_name,
+        min((value for value in oldest if value is not None), default=None)
     )
 
+    # уведомления получают все воркеры, чужие фильмы загрузят владельцы партиций
+    extractor.pending_film_ids = set()
+
+
+def run_indexes(
+    config: ETLServicesConfig,
+    pipelines: list[IndexPipeline],
+    leases: Optional[PartitionLeases],
+    state: State,
+    logger: logging.Logger
+):
+    """
+    Функция для одновременного прохода ETL по всем индексам,
+    у каждого индекса свой поток и своё подключение из общего пула.
+    При работе по партициям после получения новой партиции
+    состояние перечитывается из хранилища, а индексы без партиций
+    загружает воркер, арендовавший нулевую партицию
+    """
+    partitions = None
+    if leases is not None:
+        held = set(leases.held)
+        partitions = leases.claim()
+        if set(partitions) - held:
+            state.reload()
+
+    with ThreadPoolExecutor(max_workers=len(pipelines)) as executor:
+        futures = []
+        for name, extractor, transformer, loader in pipelines:
+            stages = (extractor, transformer, loader, state, logger)
+            if partitions is None:
+                futures.append(executor.submit(run_etl, config, *stages))
+            elif extractor.queries.partitioned:
+                futures.append(executor.submit(run_partitions, config, partitions, *stages))
+            elif 0 in partitions:
+                futures.append(executor.submit(run_etl, config, *stages))
+            else:
+                extractor.pending_film_ids = set()
+                logger.info('Index %s is loaded by the owner of partition 0', name)
+
+        for future in futures:
+            future.result()
+
+
+def reindex(
+    config: ETLServicesConfig,
+    extractor: PostgresExtractor,
+    transformer: Transformer,
+    loader: ElasticsearchLoader,
+    state: State,
+    logger: logging.Logger
+):
+    """
+    Функция для полной переиндексации без простоя.
+    Данные с самого начала загружаются в новую версию индекса,
+    после чего на неё переключается алиас, а watermark'и переиндексации
+    становятся рабочим состоянием. Постоянный ETL на это время
+    нужно остановить, иначе он продолжит писать в старую версию индекса
+    """
+    logger.info('Full reindex of %s started', loader.index_name)
+    reindex_state = State(MemoryStorage())
+    extractor.state = reindex_state
+
+    # журнал изменений хранит только свежие изменения,
+    # поэтому полная загрузка идёт по watermark'ам, а журнал
+    # продолжает читаться с позиции на момент начала переиндексации
+    source = extractor.source
+    if source == 'change_log':
+        reindex_state.set_state(
+            extractor.state_key('change_log_position'),
+            {'txid': extractor.change_log_horizon(), 'seq': 0}
+        )
+        extractor.source = 'modified'
+
+    loader.start_reindex()
+    try:
+        # повтор прохода продолжает с пачки, сохранённой в reindex_state
+        backoff()(run_etl)(config, extractor, transformer, loader, reindex_state, logger)
+    finally:
+        extractor.source = source
+    loader.finish_reindex()
+
+    values = reindex_state.state
+    if config.partitions > 1 and extractor.queries.partitioned:
+        values = {
+            partition_state_key(key, (partition, config.partitions)): value
+            for key, value in values.items()
+            for partition in range(config.partitions)
+        }
+    state.commit(values)
+    extractor.state = state
+    logger.info('Full reindex of %s finished', loader.index_name)
+
+
+def replay(
+    config: ETLServicesConfig,
+    extractor: PostgresExtractor,
+    transformer: Transformer,
+    loader: ElasticsearchLoader,
+    dead_letters: BaseDeadLetterStorage,
+    logger: logging.Logger
+):
+    """
+    Функция для повторной загрузки незагруженных документов.
+    Документы заново извлекаются из Postgres по id, поэтому
+    в индекс попадают исправленные данные, а не устаревшая копия,
+    и загружаются пачками. Записи успешно загруженных документов
+    удаляются, записи снова не загруженных остаются
+    """
+    letters = dead_letters.retrieve_letters(loader.index_name)
+    if not letters:
+        return
+    logger.info('Replaying %d dead letters of %s', len(letters), loader.index_name)
+
+    keys = {}
+    for letter in letters:
+        keys.setdefault(letter['doc_id'], []).append(letter['key'])
+    ids = list(keys)
+
+    replayed = 0
+    for i in range(0, len(ids), config.batch_size):
+        chunk = ids[i:i + config.batch_size]
+        transformed_batch = transformer.transform(extractor.extract_documents(chunk))
+        report = loader.load(transformed_batch, dead_letter=False)
+        failed = {str(failure['_id']) for failure in report.failed}
+        dead_letters.delete_letters([
+            key for id_ in chunk if id_ not in failed for key in keys[id_]
+        ])
+        replayed += len(chunk) - len(failed)
+
     logger.info(
-        f'This ETL process time:'
-        f'{state.get_state("last_etl_process_time")}'
+        'Replayed %d of %d documents of %s',
+        replayed, len(ids), loader.index_name
     )
 
-    logger.info('ETL process finished')
 
-    state.set_state('previous_extracted_ids', [])
+def build_pipelines(
+    config: ETLServicesConfig,
+    connection: PostgresConnectionPool,
+    state: State,
+    logger: logging.Logger,
+    dead_letters: Optional[BaseDeadLetterStorage] = None
+) -> list[IndexPipeline]:
+    """
+    Функция для сборки стадий ETL индексов из ES_INDEXES
+    Args:
+        config: конфигурация ETL
+        connection: общий пул подключений к Postgres
+        state: состояние ETL
+        logger: логгер
+        dead_letters: хранилище незагруженных документов
+    Returns:
+        список пайплайнов индексов
+    """
+    names = [name.strip() for name in config.indexes.split(',') if name.strip()]
+    unknown = set(names) - set(INDEXES)
+    if unknown:
+        raise ValueError(f'Unknown ES_INDEXES: {", ".join(sorted(unknown))}')
+    if len(names) > config.pg_pool_size:
+        raise ValueError('PG_POOL_SIZE must not be less than the number of ES_INDEXES')
+
+    pipelines = []
+    for name in names:
+        index = INDEXES[name]
+        batch_controller = None
+        if config.adaptive_batch:
+            batch_controller = BatchSizeController(
+                logger,
+                initial=config.batch_size,
+                min_size=config.batch_size_min,
+                max_size=config.batch_size_max,
+                target_latency=config.bulk_target_latency,
+                target_bytes=config.bulk_target_bytes,
+                increase_step=config.batch_size_step,
+                decrease_factor=config.batch_size_decrease
+            )
+        extractor = PostgresExtractor(
+            config.postgres,
+            config.batch_size,
+            state,
+            logger,
+            itersize=config.itersize,
+            server_side_cursor=config.server_side_cursor,
+            raw_documents=config.raw_documents,
+            source=config.extract_source,
+            queries=index.queries,
+            connection=connection,
+            batch_controller=batch_controller,
+            index_name=name
+        )
+        loader = ElasticsearchLoader(
+            config.elastic,
+            logger,
+            maxsize=config.es_maxsize,
+            timeout=config.es_timeout,
+            indexer=BulkIndexer(
+                logger,
+                thread_count=config.bulk_thread_count,
+                chunk_size=config.bulk_chunk_size,
+                max_chunk_bytes=config.bulk_max_chunk_bytes,
+                max_retries=config.bulk_max_retries
+            ),
+            index_config=index.index_config,
+            # хэши хранятся по id документа без имени индекса
+            digests=get_digest_storage(config) if name == 'movies' else None,
+            batch_controller=batch_controller,
+            dead_letters=dead_letters
+        )
+        transformer = index.transformer(raw_documents=extractor.raw_documents)
+        pipelines.append(IndexPipeline(name, extractor, transformer, loader))
+
+    # журнал изменений общий, его можно удалять только до позиции,
+    # которую уже загрузили все читающие его индексы и партиции
+    change_log_keys = []
+    for pipeline in pipelines:
+        if pipeline.extractor.source != 'change_log':
+            continue
+        key = pipeline.extractor.state_key('change_log_position')
+        if config.partitions > 1 and pipeline.extractor.queries.partitioned:
+            change_log_keys.extend(
+                partition_state_key(key, (partition, config.partitions))
+                for partition in range(config.partitions)
+            )
+        else:
+            change_log_keys.append(key)
+    for pipeline in pipelines:
+        pipeline.extractor.change_log_keys = change_log_keys
+    return pipelines
+
+
+async def run_async_etl(
+    config: ETLServicesConfig,
+    state: State,
+    logger: logging.Logger,
+    dead_letters: Optional[BaseDeadLetterStorage] = None
+):
+    """
+    Функция для постоянного ETL на асинхронном движке:
+    конвейеры всех индексов работают одновременно на одном event loop
+    с общим пулом подключений asyncpg
+    """
+    # asyncpg и aiohttp нужны только асинхронному движку
+    from etl_process.async_elasticsearch_loader import AsyncElasticsearchLoader
+    from etl_process.async_pipeline import AsyncPipeline, run_async_pipelines
+    from etl_process.async_postgres_extractor import (AsyncPostgresExtractor,
+                                                      create_pool)
+
+    names = [name.strip() for name in config.indexes.split(',') if name.strip()]
+    unknown = set(names) - set(INDEXES)
+    if unknown:
+        raise ValueError(f'Unknown ES_INDEXES: {", ".join(sorted(unknown))}')
+
+    pool = await create_pool(config.postgres, config.pg_pool_size)
+    pipelines = []
+    for name in names:
+        index = INDEXES[name]
+        extractor = AsyncPostgresExtractor(
+            pool,
+            config.batch_size,
+            state,
+            logger,
+            itersize=config.itersize,
+            raw_documents=config.raw_documents,
+            queries=index.queries,
+            index_name=name
+        )
+        loader = AsyncElasticsearchLoader(
+            config.elastic,
+            logger,
+            maxsize=config.es_maxsize,
+            timeout=config.es_timeout,
+            chunk_size=config.bulk_chunk_size,
+            max_chunk_bytes=config.bulk_max_chunk_bytes,
+            max_retries=config.bulk_max_retries,
+            index_config=index.index_config,
+            dead_letters=dead_letters
+        )
+        await loader.create_index()
+        pipelines.append(AsyncPipeline(
+            extractor,
+            index.transformer(raw_documents=extractor.raw_documents),
+            loader,
+            state,
+            logger,
+            queue_size=config.queue_size
+        ))
+
+    try:
+        while True:
+            logger.info('Async ETL process started')
+            await run_async_pipelines(pipelines, logger)
+            metrics.write_textfile(config.metrics_textfile)
+            logger.info('Waiting %s seconds before next ETL process', config.sleep_time)
+            await asyncio.sleep(config.sleep_time)
+    finally:
+        for pipeline in pipelines:
+            await pipeline.loader.close()
+        await pool.close()
+
+
+def get_state_storage(config: ETLServicesConfig) -> BaseStorage:
+    """
+    Функция для выбора хранилища состояния по конфигурации
+    Args:
+        config: конфигурация ETL
+    Returns:
+        хранилище состояния
+    """
+    if config.state_storage == 'postgres':
+        return PostgresStorage(config.postgres, config.state_table)
+    return JsonFileStorage(config.state_file_path)
+
+
+def get_dead_letter_storage(config: ETLServicesConfig) -> Optional[BaseDeadLetterStorage]:
+    """
+    Функция для выбора хранилища незагруженных документов по конфигурации
+    Args:
+        config: конфигурация ETL
+    Returns:
+        хранилище или None, если незагруженные документы только логируются
+    """
+    if config.dead_letter_storage == 'postgres':
+        return PostgresDeadLetterStorage(config.postgres, config.dead_letter_table)
+    if config.dead_letter_storage == 'ndjson':
+        return NDJSONDeadLetterStorage(config.dead_letter_file_path)
+    return None
+
+
+def get_digest_storage(config: ETLServicesConfig) -> Optional[BaseDigestStorage]:
+    """
+    Функция для выбора хранилища хэшей документов по конфигурации
+    Args:
+        config: конфигурация ETL
+    Returns:
+        хранилище хэшей или None, если пропуск неизменённых документов выключен
+    """
+    if config.digest_storage == 'postgres':
+        return PostgresDigestStorage(config.postgres, config.digest_table)
+    if config.digest_storage == 'sqlite':
+        return SQLiteDigestStorage(config.digest_file_path)
+    return None
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Postgres to Elasticsearch ETL')
+    parser.add_argument(
+        'command',
+        nargs='?',
+        default='run',
+        choices=['run', 'reindex', 'replay', 'reconcile'],
+        help=(
+            'run: incremental ETL loop, reindex: full zero-downtime reindex, '
+            'replay: re-submit dead-lettered documents, '
+            'reconcile: fix drift between Postgres and Elasticsearch'
+        )
+    )
+    args = parser.parse_args()
+
     config = ETLServicesConfig()
     logger = get_logger(__name__)
 
-    state = State(JsonFileStorage('state.json'))
+    if config.partitions > 1 and config.state_storage != 'postgres':
+        raise ValueError('ETL_PARTITIONS > 1 requires STATE_STORAGE=postgres')
+    if config.engine == 'async' and (
+        config.partitions > 1 or config.listen_notify
+        or config.extract_source != 'modified'
+        or config.adaptive_batch or config.digest_storage != 'none'
+    ):
+        raise ValueError(
+            'ETL_ENGINE=async supports EXTRACT_SOURCE=modified only, without '
+            'ETL_PARTITIONS, LISTEN_NOTIFY, ADAPTIVE_BATCH and DIGEST_STORAGE'
+        )
+
+    state = State(get_state_storage(config))
+    metrics.start_exporter(config.metrics_port)
+
+    dead_letters = get_dead_letter_storage(config)
+    if config.engine == 'async' and args.command == 'run':
+        asyncio.run(run_async_etl(config, state, logger, dead_letters))
+        raise SystemExit
 
     pg_dsn = config.postgres
-    es_dsn = config.elastic
-    batch_size = config.batch_size
+    connection = PostgresConnectionPool(pg_dsn, config.pg_pool_size)
+    pipelines = build_pipelines(config, connection, state, logger, dead_letters)
+
+    if args.command == 'reindex':
+        with ThreadPoolExecutor(max_workers=len(pipelines)) as executor:
+            futures = [
+                executor.submit(reindex, config, *pipeline[1:], state, logger)
+                for pipeline in pipelines
+            ]
+            for future in futures:
+                future.result()
+        raise SystemExit
+
+    if args.command == 'replay':
+        if dead_letters is None:
+            raise ValueError('replay requires DEAD_LETTER_STORAGE')
+        for pipeline in pipelines:
+            replay(config, *pipeline[1:], dead_letters, logger)
+        raise SystemExit
 
-    extractor = PostgresExtractor(pg_dsn, batch_size, state, logger)
-    transformer = Transformer()
-    loader = ElasticsearchLoader(es_dsn, logger)
+    if args.command == 'reconcile':
+        for name, extractor, transformer, loader in pipelines:
+            if extractor.queries.reconcile is None:
+                logger.info('Index %s does not support reconciliation', name)
+                continue
+            Reconciler(
+                extractor,
+                transformer,
+                loader,
+                logger,
+                batch_size=config.batch_size,
+                page_size=config.reconcile_page_size
+            ).run()
+        raise SystemExit
 
     sleep_time = config.sleep_time
+    listener = None
+    if config.listen_notify:
+        listener = ChangeListener(
+            pg_dsn,
+            logger,
+            debounce=config.notify_debounce,
+            max_delay=config.notify_max_delay
+        )
+        # подписка до первого прохода, чтобы не потерять уведомления за него
+        listener.connect()
 
-    while True:
-        etl_process(extractor, transformer, loader, state, logger)
-        logger.info('Waiting %s seconds before next ETL process', sleep_time)
-        time.sleep(sleep_time)
+    leases = None
+    if config.partitions > 1:
+        leases = PartitionLeases(
+            pg_dsn,
+            config.partitions,
+            config.max_leases,
+            logger
+        )
+
+    try:
+        while True:
+            try:
+                run_indexes(config, pipelines, leases, state, logger)
+            except Exception:
+                logger.exception('ETL process failed, next run resumes from the last saved batch')
+            metrics.write_textfile(config.metrics_textfile)
+            if listener is None:
+                logger.info('Waiting %s seconds before next ETL process', sleep_time)
+                time.sleep(sleep_time)
+                continue
+
+            logger.info('Waiting for changes, at most %s seconds', sleep_time)
+            changes = listener.wait(sleep_time)
+            if changes:
+                # id из связей передаются индексам, документы которых
+                # определяются этим полем, жанры догоняются по watermark'ам
+                for pipeline in pipelines:
+                    ids = changes.get(pipeline.extractor.queries.change_log_key)
+                    if ids and pipeline.extractor.queries.change_log:
+                        pipeline.extractor.pending_film_ids |= ids
+    finally:
+        # партиции остановленного воркера сразу достаются остальным
+        if leases is not None:
+            leases.release()
@@ -0,0 +1,263 @@
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+
+CONSTRAINTS_QUERY = (
+    'SELECT con.conname, rel.relname, con.contype, '
+    'pg_get_constraintdef(con.oid), '
+    'ARRAY(SELECT att.attname '
+    'FROM unnest(con.conkey) WITH ORDINALITY k(attnum, ord) '
+    'JOIN pg_attribute att ON att.attrelid = con.conrelid AND att.attnum = k.attnum '
+    'ORDER BY k.ord), '
+    'parent.relname, '
+    'ARRAY(SELECT att.attname '
+    'FROM unnest(con.confkey) WITH ORDINALITY k(attnum, ord) '
+    'JOIN pg_attribute att ON att.attrelid = con.confrelid AND att.attnum = k.attnum '
+    'ORDER BY k.ord) '
+    'FROM pg_constraint con '
+    'JOIN pg_class rel ON rel.oid = con.conrelid '
+    'LEFT JOIN pg_class parent ON parent.oid = con.confrelid '
+    'WHERE con.connamespace = \'content\'::regnamespace '
+    'AND con.contype IN (\'u\', \'f\') '
+    'ORDER BY con.conname;'
+)
+
+INDEXES_QUERY = (
+    'SELECT idx.relname, pg_get_indexdef(i.indexrelid) '
+    'FROM pg_index i '
+    'JOIN pg_class idx ON idx.oid = i.indexrelid '
+    'WHERE idx.relnamespace = \'content\'::regnamespace '
+    'AND NOT EXISTS (SELECT 1 FROM pg_constraint con '
+    'WHERE con.conindid = i.indexrelid) '
+    'ORDER BY idx.relname;'
+)
+
+TRIGGERS_QUERY = (
+    'SELECT DISTINCT rel.relname '
+    'FROM pg_trigger trg '
+    'JOIN pg_class rel ON rel.oid = trg.tgrelid '
+    'WHERE rel.relnamespace = \'content\'::regnamespace '
+    'AND NOT trg.tgisinternal '
+    'ORDER BY rel.relname;'
+)
+
+
+class DeferredSchema:
+    """
+    Вторичные индексы, ограничения уникальности и внешние ключи
+    схемы content на время первичной загрузки.
+    Пользовательские триггеры (уведомления и журнал изменений)
+    на это время отключаются, поэтому после загрузки
+    индексы Elasticsearch строятся полной переиндексацией ETL.
+    Определения сохраняются в файл до удаления, поэтому после падения
+    загрузки они восстанавливаются следующим запуском.
+    Первичные ключи не трогаются
+    """
+    def __init__(self, dsl: dict, file_path: str, workers: int = 1):
+        self.dsl = dsl
+        self.file_path = file_path
+        self.workers = workers
+        self.logger = logging.getLogger(__name__)
+
+    def read_definitions(self) -> dict:
+        """Метод для чтения определений из каталога Postgres"""
+        with psycopg2.connect(**self.dsl) as conn, conn.cursor() as pg_cursor:
+            pg_cursor.execute(CONSTRAINTS_QUERY)
+            constraints = pg_cursor.fetchall()
+            pg_cursor.execute(INDEXES_QUERY)
+            indexes = pg_cursor.fetchall()
+            pg_cursor.execute(TRIGGERS_QUERY)
+            triggers = pg_cursor.fetchall()
+        conn.close()
+        return {
+            'unique': [
+                {'name': name, 'table': table, 'definition': definition, 'columns': columns}
+                for name, table, contype, definition, columns, _, _ in constraints
+                if contype == 'u'
+            ],
+            'foreign': [
+                {
+                    'name': name,
+                    'table': table,
+                    'definition': definition,
+                    'columns': columns,
+                    'parent': parent,
+                    'parent_columns': parent_columns
+                }
+                for name, table, contype, definition, columns, parent, parent_columns
+                in constraints
+                if contype == 'f'
+            ],
+            'indexes': [
+                {'name': name, 'definition': definition}
+                for name, definition in indexes
+            ],
+            'triggers': [table for table, in triggers]
+        }
+
+    def drop(self) -> None:
+        """
+        Метод для сохранения определений, удаления индексов и ограничений
+        и отключения пользовательских триггеров.
+        Если файл остался от прерванной загрузки, используются его определения
+        """
+        if os.path.exists(self.file_path):
+            with open(self.file_path) as file:
+                definitions = json.load(file)
+            self.logger.warning('Using saved schema definitions from an interrupted load')
+        else:
+            definitions = self.read_definitions()
+            tmp_path = f'{self.file_path}.tmp'
+            with open(tmp_path, 'w') as file:
+                json.dump(definitions, file, indent=2)
+            os.replace(tmp_path, self.file_path)
+
+        with psycopg2.connect(**self.dsl) as conn, conn.cursor() as pg_cursor:
+            for kind in ('foreign', 'unique'):
+                for item in definitions[kind]:
+                    pg_cursor.execute(
+                        f'ALTER TABLE content.{item["table"]} '
+                        f'DROP CONSTRAINT IF EXISTS {item["name"]};'
+                    )
+            for item in definitions['indexes']:
+                pg_cursor.execute(f'DROP INDEX IF EXISTS content.{item["name"]};')
+            for table in definitions.get('triggers', []):
+                pg_cursor.execute(f'ALTER TABLE content.{table} DISABLE TRIGGER USER;')
+        conn.close()
+        self.logger.info(
+            f'Dropped {len(definitions["foreign"])} foreign keys, '
+            f'{len(definitions["unique"])} unique constraints '
+            f'and {len(definitions["indexes"])} indexes, '
+            f'disabled triggers of {len(definitions.get("triggers", []))} tables'
+        )
+
+    def execute(self, *queries: str) -> None:
+        """Метод для выполнения запросов на отдельном подключении"""
+        conn = psycopg2.connect(**self.dsl)
+        try:
+            with conn, conn.cursor() as pg_cursor:
+                for query in queries:
+                    self.logger.info(f'Executing {query}')
+                    pg_cursor.execute(query)
+        finally:
+            conn.close()
+
+    def existing(self) -> set:
+        """Метод для получения имён существующих индексов и ограничений схемы"""
+        with psycopg2.connect(**self.dsl) as conn, conn.cursor() as pg_cursor:
+            pg_cursor.execute(
+                'SELECT conname FROM pg_constraint '
+                'WHERE connamespace = \'content\'::regnamespace '
+                'UNION SELECT relname FROM pg_class '
+                'WHERE relnamespace = \'content\'::regnamespace AND relkind = \'i\';'
+            )
+            names = {row[0] for row in pg_cursor.fetchall()}
+        conn.close()
+        return names
+
+    def restore(self) -> None:
+        """
+        Метод для восстановления индексов и ограничений после загрузки.
+        Индексы и ограничения уникальности строятся параллельно,
+        повторы строк, которые загрузка с ограничением пропустила бы,
+        удаляются. Внешние ключи добавляются без проверки и проверяются
+        одним проходом по таблице, строки без родителя, которые загрузка
+        с внешним ключом отклонила бы, перед этим удаляются.
+        Затем собирается статистика. Триггеры включаются в любом случае,
+        даже если восстановление упало.
+        Уже восстановленные объекты пропускаются, поэтому
+        после ошибки восстановление можно повторить
+        """
+        if not os.path.exists(self.file_path):
+            return
+        with open(self.file_path) as file:
+            definitions = json.load(file)
+        try:
+            self.restore_definitions(definitions)
+        finally:
+            # без триггеров ETL не видит изменений из админки
+            self.execute(*(
+                f'ALTER TABLE content.{table} ENABLE TRIGGER USER;'
+                for table in definitions.get('triggers', [])
+            ))
+        os.remove(self.file_path)
+        self.logger.info(
+            'Indexes, constraints and triggers restored, '
+            'run a full ETL reindex to load the data into Elasticsearch'
+        )
+
+    def restore_definitions(self, definitions: dict) -> None:
+        """Метод для восстановления индексов и ограничений по определениям"""
+        existing = self.existing()
+
+        builds = [
+            (item['definition'] + ';',)
+            for item in definitions['indexes'] if item['name'] not in existing
+        ]
+        for item in definitions['unique']:
+            if item['name'] in existing:
+                continue
+            table = f'content.{item["table"]}'
+            duplicates = ' AND '.join(
+                f'a.{column} = b.{column}' for column in item['columns']
+            )
+            builds.append((
+                f'DELETE FROM {table} a USING {table} b '
+                f'WHERE a.ctid > b.ctid AND {duplicates};',
+                f'ALTER TABLE {table} ADD CONSTRAINT {item["name"]} '
+                f'{item["definition"]};'
+            ))
+        self.run_parallel(builds)
+
+        # ключ может быть добавлен без проверки прошлым восстановлением
+        for item in definitions['foreign']:
+            self.delete_orphans(item)
+        for item in definitions['foreign']:
+            if item['name'] not in existing:
+                self.execute(
+                    f'ALTER TABLE content.{item["table"]} ADD CONSTRAINT {item["name"]} '
+                    f'{item["definition"]} NOT VALID;'
+                )
+        # проверка уже проверенного ключа ничего не делает
+        self.run_parallel([
+            (f'ALTER TABLE content.{item["table"]} VALIDATE CONSTRAINT {item["name"]};',)
+            for item in definitions['foreign']
+        ])
+        self.execute('ANALYZE;')
+
+    def delete_orphans(self, item: dict) -> None:
+        """
+        Метод для удаления строк, ссылающихся на отсутствующие
+        строки родительской таблицы внешнего ключа
+        """
+        if 'parent' not in item:
+            return
+        matches = ' AND '.join(
+            f'p.{parent_column} = c.{column}'
+            for column, parent_column in zip(item['columns'], item['parent_columns'])
+        )
+        not_null = ' AND '.join(f'c.{column} IS NOT NULL' for column in item['columns'])
+        conn = psycopg2.connect(**self.dsl)
+        try:
+            with conn, conn.cursor() as pg_cursor:
+                pg_cursor.execute(
+                    f'DELETE FROM content.{item["table"]} c '
+                    f'WHERE {not_null} AND NOT EXISTS ('
+                    f'SELECT 1 FROM content.{item["parent"]} p WHERE {matches});'
+                )
+                if pg_cursor.rowcount:
+                    self.logger.warning(
+                        f'Deleted {pg_cursor.rowcount} {item["table"]} rows '
+                        f'without {item["parent"]} for {item["name"]}'
+                    )
+        finally:
+            conn.close()
+
+    def run_parallel(self, tasks: list) -> None:
+        """Метод для выполнения групп запросов на нескольких подключениях"""
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as executor:
+            for future in [executor.submit(self.execute, *queries) for queries in tasks]:
+                future.result()
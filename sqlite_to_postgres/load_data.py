@@ -1,14 +1,20 @@
+import argparse
 import logging
 import logging.config
 import os
 import sqlite3
 import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from contextlib import contextmanager
+from typing import Optional
 
 import psycopg2
+from deferred_schema import DeferredSchema
 from dotenv import load_dotenv
+from migration_checkpoint import MigrationCheckpoint
 from postgres_saver import PostgresSaver
 from psycopg2.extensions import connection as _connection
+from schema_mapping import build_mappings
 from sqlite_extractor import SQLiteExtractor
 
 if not os.path.exists('logs'):
@@ -72,18 +78,189 @@ def postgres_connection(dsl) -> _connection:
         logger.info('Connection to Postgres closed')
 
 
+def get_mappings(db_path: str, dsl: dict) -> dict:
+    """
+    Метод для построения соответствий колонок всех таблиц
+    один раз перед переносом
+    """
+    mappings = {}
+    with sqlite_connection(db_path) as sqlite_conn,\
+            postgres_connection(dsl) as pg_conn:
+        tables = SQLiteExtractor(sqlite_conn).extract_table_names()
+        mappings = build_mappings(sqlite_conn, pg_conn, tables)
+    return mappings
+
+
 def load_from_sqlite(
     connection: sqlite3.Connection,
-    pg_conn: _connection
+    pg_conn: _connection,
+    mappings: dict,
+    method: str = 'copy',
+    pack_size: int = 1000,
+    checkpoint: Optional[MigrationCheckpoint] = None
+        ) -> None:
+    """
+    Основной метод загрузки данных из SQLite в Postgres.
+    method: copy - пакеты загружаются через COPY,
+    insert - многострочными INSERT.
+    С checkpoint загрузка продолжается с последних сохранённых
+    пакетов, а несохранённые пакеты запоминаются для повтора
+    """
+    sqlite_extractor = SQLiteExtractor(connection, pack_size, mappings)
+    postgres_saver = PostgresSaver(pg_conn, method, mappings)
+    for table_name, first, last, table_data in sqlite_extractor.extract_pack(checkpoint):
+        saved = postgres_saver.save(table_name, table_data)
+        if checkpoint is not None:
+            checkpoint.save_pack(table_name, first, last, saved)
+
+
+def retry_failed(
+    connection: sqlite3.Connection,
+    pg_conn: _connection,
+    checkpoint: MigrationCheckpoint,
+    mappings: dict,
+    method: str = 'copy'
+        ) -> None:
+    """Метод для повторной загрузки только несохранённых пакетов"""
+    sqlite_extractor = SQLiteExtractor(connection, mappings=mappings)
+    postgres_saver = PostgresSaver(pg_conn, method, mappings)
+    for table_name, packs in checkpoint.failed_packs().items():
+        for first, last in packs:
+            logger.info(f'Retrying {table_name} pack from rowid {first} to {last}')
+            table_data = sqlite_extractor.extract_range(table_name, first, last)
+            if table_data:
+                saved = postgres_saver.save(table_name, table_data)
+            else:
+                # строк диапазона больше нет в SQLite, повторять нечего
+                logger.info(f'No {table_name} rows from rowid {first} to {last}, pack cleared')
+                saved = True
+            checkpoint.retried_pack(table_name, first, last, saved)
+
+
+def report_failed(checkpoint: MigrationCheckpoint) -> int:
+    """Метод для итогового отчёта о несохранённых пакетах"""
+    failed = checkpoint.failed_packs()
+    for table_name, packs in failed.items():
+        ranges = ', '.join(f'{first}-{last}' for first, last in packs)
+        logger.warning(f'Not saved {len(packs)} {table_name} packs, rowids: {ranges}')
+    count = sum(len(packs) for packs in failed.values())
+    if count:
+        logger.warning(f'{count} packs not saved, run with retry-failed to load them again')
+    else:
+        logger.info('All packs saved')
+    return count
+
+
+def migrate_table(
+    db_path: str,
+    dsl: dict,
+    table: str,
+    mappings: dict,
+    method: str = 'copy',
+    pack_size: int = 1000,
+    checkpoint: Optional[MigrationCheckpoint] = None
+        ) -> str:
+    """
+    Метод для переноса одной таблицы в процессе-воркере
+    со своими подключениями к SQLite и Postgres.
+    Ошибка подключения поднимается, чтобы зависимые таблицы не запускались
+    """
+    logger.info(f'Migrating {table} table...')
+    migrated = False
+    with sqlite_connection(db_path) as sqlite_conn,\
+            postgres_connection(dsl) as pg_conn:
+        sqlite_extractor = SQLiteExtractor(sqlite_conn, pack_size, mappings)
+        postgres_saver = PostgresSaver(pg_conn, method, mappings)
+        after = checkpoint.get_position(table) if checkpoint else 0
+        for first, last, pack in sqlite_extractor.extract_table(table, after):
+            saved = postgres_saver.save(table, pack)
+            if checkpoint is not None:
+                checkpoint.save_pack(table, first, last, saved)
+        migrated = True
+    # менеджеры подключений логируют и подавляют ошибки баз
+    if not migrated:
+        raise RuntimeError(f'Table {table} not migrated, connection error')
+    logger.info(f'Table {table} migrated')
+    return table
+
+
+def parallel_load_from_sqlite(
+    db_path: str,
+    dsl: dict,
+    workers: int,
+    mappings: dict,
+    method: str = 'copy',
+    pack_size: int = 1000,
+    checkpoint: Optional[MigrationCheckpoint] = None
         ) -> None:
-    """Основной метод загрузки данных из SQLite в Postgres"""
-    sqlite_extractor = SQLiteExtractor(connection)
-    postgres_saver = PostgresSaver(pg_conn)
-    for table_name, table_data in sqlite_extractor.extract_pack():
-        postgres_saver.save_pack(table_name, table_data)
+    """
+    Метод для параллельной загрузки данных из SQLite в Postgres.
+    Независимые таблицы переносятся одновременно в процессах-воркерах,
+    таблица запускается только после того, как перенесены
+    все таблицы, на которые она ссылается внешними ключами.
+    Таблицы, зависящие от неперенесённой таблицы, пропускаются,
+    остальные переносятся до конца, затем поднимается ошибка
+    """
+    tables, dependencies = list(mappings), {}
+    with postgres_connection(dsl) as pg_conn:
+        dependencies = PostgresSaver(pg_conn).get_dependencies()
+
+    pending = {
+        table: dependencies.get(table, set()) & set(tables)
+        for table in tables
+    }
+    done, failed = set(), set()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while pending or running:
+            while skipped := [
+                table for table, parents in pending.items() if parents & failed
+            ]:
+                for table in skipped:
+                    del pending[table]
+                    failed.add(table)
+                    logger.error(f'Table {table} skipped, its parent tables are not migrated')
+            ready = [table for table, parents in pending.items() if parents <= done]
+            for table in ready:
+                del pending[table]
+                running[executor.submit(
+                    migrate_table, db_path, dsl, table, mappings,
+                    method, pack_size, checkpoint
+                )] = table
+            if not running:
+                if pending:
+                    raise ValueError(f'Cyclic foreign keys between tables: {sorted(pending)}')
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                table = running.pop(future)
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception(f'Table {table} not migrated')
+                    failed.add(table)
+                else:
+                    done.add(table)
+
+    if failed:
+        raise RuntimeError(f'Tables not migrated: {", ".join(sorted(failed))}')
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SQLite to Postgres migration')
+    parser.add_argument(
+        'command',
+        nargs='?',
+        default='load',
+        choices=['load', 'retry-failed', 'restore-schema'],
+        help=(
+            'load: migrate tables, resuming from the checkpoint, '
+            'retry-failed: load again only the packs that were not saved, '
+            'restore-schema: rebuild indexes and constraints dropped by a fast load'
+        )
+    )
+    args = parser.parse_args()
+
     load_dotenv()
     dsl = {
         'dbname': os.environ.get('POSTGRES_DB'),
@@ -92,6 +269,48 @@ if __name__ == '__main__':
         'host': os.environ.get('POSTGRES_HOST'),
         'port': os.environ.get('POSTGRES_PORT')
     }
-    with sqlite_connection(os.environ.get('DB_SQLITE_PATH')) as sqlite_conn,\
-            postgres_connection(dsl) as pg_conn:
-        load_from_sqlite(sqlite_conn, pg_conn)
+    db_path = os.environ.get('DB_SQLITE_PATH')
+    method = os.environ.get('SQLITE_LOAD_METHOD', 'copy')
+    pack_size = int(os.environ.get('SQLITE_PACK_SIZE', 10000))
+    workers = int(os.environ.get('SQLITE_WORKERS', 1))
+    checkpoint = MigrationCheckpoint(
+        os.environ.get('SQLITE_CHECKPOINT_PATH', 'migration_checkpoint.json'),
+        f'{dsl["host"]}:{dsl["port"]}/{dsl["dbname"]}'
+    )
+    # определения индексов и ограничений, удалённых на время быстрой загрузки
+    schema = DeferredSchema(
+        dsl,
+        os.environ.get('SQLITE_SCHEMA_PATH', 'deferred_schema.json'),
+        workers
+    )
+    if args.command == 'restore-schema':
+        schema.restore()
+        raise SystemExit
+
+    checkpoint.verify_target()
+    mappings = get_mappings(db_path, dsl)
+    if args.command == 'load' and os.environ.get('SQLITE_FAST_LOAD', 'false').lower() == 'true':
+        schema.drop()
+    try:
+        if args.command == 'retry-failed':
+            with sqlite_connection(db_path) as sqlite_conn,\
+                    postgres_connection(dsl) as pg_conn:
+                retry_failed(sqlite_conn, pg_conn, checkpoint, mappings, method)
+        elif workers > 1:
+            parallel_load_from_sqlite(
+                db_path, dsl, workers, mappings, method, pack_size, checkpoint
+            )
+        else:
+            with sqlite_connection(db_path) as sqlite_conn,\
+                    postgres_connection(dsl) as pg_conn:
+                load_from_sqlite(sqlite_conn, pg_conn, mappings, method, pack_size, checkpoint)
+    except BaseException:
+        # ошибка восстановления не должна скрыть ошибку загрузки
+        try:
+            schema.restore()
+        except Exception:
+            logger.exception('Schema not restored, run restore-schema after fixing it')
+        raise
+    # восстанавливает и то, что осталось от прерванной быстрой загрузки
+    schema.restore()
+    report_failed(checkpoint)
@@ -0,0 +1,87 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from typing import Optional
+
+
+class MigrationCheckpoint:
+    """
+    Прогресс переноса в JSON файле: последний сохранённый rowid
+    каждой таблицы и диапазоны rowid несохранённых пакетов.
+    Файл изменяется под блокировкой, поэтому его могут
+    использовать несколько процессов-воркеров.
+    В файл записывается база Postgres, в которую идёт перенос,
+    продолжить перенос в другую базу нельзя
+    """
+    def __init__(self, file_path: str, target: Optional[str] = None):
+        self.file_path = file_path
+        self.lock_path = f'{file_path}.lock'
+        # база Postgres в виде host:port/dbname
+        self.target = target
+
+    @contextmanager
+    def locked(self) -> dict:
+        """Метод для изменения прогресса под блокировкой файла"""
+        with open(self.lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                data = self.read()
+                data.setdefault('target', self.target)
+                yield data
+                tmp_path = f'{self.file_path}.tmp'
+                with open(tmp_path, 'w') as file:
+                    json.dump(data, file, indent=2)
+                os.replace(tmp_path, self.file_path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def read(self) -> dict:
+        """Метод для чтения прогресса из файла"""
+        try:
+            with open(self.file_path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {'tables': {}, 'failed': {}}
+
+    def verify_target(self) -> None:
+        """
+        Метод для проверки, что прогресс записан для той же базы Postgres.
+        Иначе перенос в новую базу пропустил бы уже перенесённые таблицы
+        """
+        target = self.read().get('target')
+        if target is not None and self.target is not None and target != self.target:
+            raise ValueError(
+                f'Checkpoint {self.file_path} belongs to {target}, not {self.target}, '
+                'delete it to migrate from scratch'
+            )
+
+    def get_position(self, table: str) -> int:
+        """Метод для получения последнего сохранённого rowid таблицы"""
+        return self.read()['tables'].get(table, 0)
+
+    def save_pack(self, table: str, first: int, last: int, saved: bool) -> None:
+        """
+        Метод для записи результата пакета: позиция таблицы сдвигается
+        в любом случае, несохранённый пакет запоминается для повтора
+        """
+        with self.locked() as data:
+            data['tables'][table] = max(data['tables'].get(table, 0), last)
+            if not saved:
+                data['failed'].setdefault(table, []).append([first, last])
+
+    def failed_packs(self) -> dict:
+        """Метод для получения несохранённых пакетов по таблицам"""
+        return {
+            table: [tuple(pack) for pack in packs]
+            for table, packs in self.read()['failed'].items() if packs
+        }
+
+    def retried_pack(self, table: str, first: int, last: int, saved: bool) -> None:
+        """Метод для записи результата повтора несохранённого пакета"""
+        if not saved:
+            return
+        with self.locked() as data:
+            packs = data['failed'].get(table, [])
+            if [first, last] in packs:
+                packs.remove([first, last])
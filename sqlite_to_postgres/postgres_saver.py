@@ -1,16 +1,78 @@
+import io
 import logging
+from typing import Optional
 
 import psycopg2
 from psycopg2.extensions import connection as _connection
 
 
+def copy_value(value) -> str:
+    """Метод для записи значения в текстовом формате COPY"""
+    if value is None:
+        return '\\N'
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+
 class PostgresSaver:
-    def __init__(self, connection: _connection):
+    def __init__(
+        self,
+        connection: _connection,
+        method: str = 'copy',
+        mappings: Optional[dict] = None
+            ):
         self.connection = connection
+        self.method = method
+        # соответствия колонок из schema_mapping.build_mappings
+        self.mappings = mappings or {}
         self.logger = logging.getLogger(__name__)
 
-    def save_pack(self, table_name: str, pack: list) -> None:
-        """Метод для сохранения данных в Postgres"""
+    def get_columns(self, table_name: str) -> list:
+        """Метод для получения колонок таблицы Postgres в порядке соответствия"""
+        return self.mappings[table_name].postgres_columns
+
+    def get_dependencies(self) -> dict:
+        """
+        Метод для получения внешних ключей схемы content:
+        для каждой таблицы - множество таблиц, на которые она ссылается
+        """
+        with self.connection.cursor() as pg_cursor:
+            pg_cursor.execute(
+                'SELECT child.relname, parent.relname '
+                'FROM pg_constraint con '
+                'JOIN pg_class child ON child.oid = con.conrelid '
+                'JOIN pg_class parent ON parent.oid = con.confrelid '
+                'WHERE con.contype = \'f\' '
+                'AND con.connamespace = \'content\'::regnamespace;'
+            )
+            rows = pg_cursor.fetchall()
+        self.connection.commit()
+        dependencies = {}
+        for child, parent in rows:
+            if child != parent:
+                dependencies.setdefault(child, set()).add(parent)
+        return dependencies
+
+    def save(self, table_name: str, pack: list) -> bool:
+        """
+        Метод для сохранения пакета способом из настроек
+        после приведения типов по колонкам
+        """
+        pack = self.mappings[table_name].convert(pack)
+        if self.method == 'copy':
+            return self.copy_pack(table_name, pack)
+        return self.save_pack(table_name, pack)
+
+    def save_pack(self, table_name: str, pack: list) -> bool:
+        """
+        Метод для сохранения данных в Postgres.
+        Возвращает False, если пакет не сохранён
+        """
         self.logger.info(f'Saving {table_name} pack...')
         with self.connection.cursor() as pg_cursor:
             query = ','.join(
@@ -20,21 +82,61 @@ class PostgresSaver:
                 ).decode('utf-8') for row in pack
             )
             try:
-                pg_cursor.execute('SELECT column_name FROM information_schema.columns '
-                                  f'WHERE table_name = \'{table_name}\';')
-                columns = pg_cursor.fetchall()
-                columns = [column[0] for column in columns]
-                columns = sorted(columns)
+                columns = self.get_columns(table_name)
 
                 pg_cursor.execute(
                     f'INSERT INTO content.{table_name} ({",".join(columns)}) '
                     f'VALUES {query} ON CONFLICT DO NOTHING'
                 )
                 self.logger.info(f'Pack {table_name} saved')
+                return True
             except psycopg2.Error:
                 self.logger.exception(
                     f'Not saved {table_name} pack from '
                     f'{pack[0][0]} to {pack[-1][0]}'
                 )
+                return False
             finally:
                 self.connection.commit()
+
+    def copy_pack(self, table_name: str, pack: list) -> bool:
+        """
+        Метод для сохранения данных в Postgres через COPY.
+        Пакет потоком копируется во временную таблицу,
+        откуда переносится в основную с ON CONFLICT DO NOTHING.
+        Возвращает False, если пакет не сохранён
+        """
+        self.logger.info(f'Copying {table_name} pack...')
+        buffer = io.StringIO()
+        for row in pack:
+            buffer.write('\t'.join(copy_value(value) for value in row))
+            buffer.write('\n')
+        buffer.seek(0)
+
+        staging = f'staging_{table_name}'
+        try:
+            columns = ','.join(self.get_columns(table_name))
+            with self.connection.cursor() as pg_cursor:
+                pg_cursor.execute(
+                    f'CREATE TEMP TABLE IF NOT EXISTS {staging} '
+                    f'(LIKE content.{table_name} INCLUDING DEFAULTS) '
+                    'ON COMMIT DELETE ROWS'
+                )
+                pg_cursor.copy_expert(
+                    f'COPY {staging} ({columns}) FROM STDIN',
+                    buffer
+                )
+                pg_cursor.execute(
+                    f'INSERT INTO content.{table_name} ({columns}) '
+                    f'SELECT {columns} FROM {staging} ON CONFLICT DO NOTHING'
+                )
+            self.connection.commit()
+            self.logger.info(f'Pack {table_name} copied')
+            return True
+        except psycopg2.Error:
+            self.connection.rollback()
+            self.logger.exception(
+                f'Not saved {table_name} pack from '
+                f'{pack[0][0]} to {pack[-1][0]}'
+            )
+            return False
@@ -0,0 +1,190 @@
+import logging
+import sqlite3
+import uuid
+from datetime import date, datetime
+from typing import Callable, NamedTuple, Optional
+
+from psycopg2.extensions import connection as _connection
+
+# Колонки SQLite, которые в Postgres называются иначе
+COLUMN_OVERRIDES = {
+    'created_at': 'created',
+    'updated_at': 'modified',
+}
+
+POSTGRES_COLUMNS_QUERY = (
+    'SELECT table_name, column_name, data_type, is_nullable, column_default '
+    'FROM information_schema.columns '
+    'WHERE table_schema = \'content\' '
+    'ORDER BY table_name, ordinal_position;'
+)
+
+logger = logging.getLogger(__name__)
+
+
+def to_timestamp(value):
+    """Метод для перевода строки SQLite во время с часовым поясом"""
+    if value is None or value == '':
+        return None
+    if not isinstance(value, str):
+        return value
+    text = value.strip().replace(' ', 'T', 1)
+    # SQLite хранит смещение как +00, fromisoformat ждёт +00:00
+    if len(text) > 3 and text[-3] in '+-' and text[-2:].isdigit():
+        text += ':00'
+    try:
+        return datetime.fromisoformat(text)
+    except ValueError:
+        return value
+
+
+def to_date(value):
+    """Метод для перевода строки SQLite в дату"""
+    if value is None or value == '':
+        return None
+    if not isinstance(value, str):
+        return value
+    try:
+        return date.fromisoformat(value.strip()[:10])
+    except ValueError:
+        return value
+
+
+def to_uuid(value):
+    """Метод для приведения UUID к каноническому виду"""
+    if value is None or value == '':
+        return None
+    try:
+        return str(uuid.UUID(str(value)))
+    except ValueError:
+        return value
+
+
+def to_number(value):
+    """Метод для перевода пустой строки в NULL для чисел"""
+    if value == '':
+        return None
+    return value
+
+
+def empty_to_null(value):
+    """Метод для перевода пустой строки в NULL для nullable строк"""
+    if value == '':
+        return None
+    return value
+
+
+def null_to_empty(value):
+    """Метод для перевода NULL в пустую строку для NOT NULL строк"""
+    if value is None:
+        return ''
+    return value
+
+
+TYPE_CONVERTERS = {
+    'timestamp with time zone': to_timestamp,
+    'timestamp without time zone': to_timestamp,
+    'date': to_date,
+    'uuid': to_uuid,
+    'double precision': to_number,
+    'real': to_number,
+    'numeric': to_number,
+    'integer': to_number,
+    'bigint': to_number,
+    'smallint': to_number,
+}
+
+TEXT_TYPES = {'text', 'character varying', 'character'}
+
+
+class TableMapping(NamedTuple):
+    """Соответствие колонок таблицы SQLite колонкам таблицы Postgres"""
+    table: str
+    sqlite_columns: list
+    postgres_columns: list
+    converters: list
+
+    def convert(self, pack: list) -> list:
+        """Метод для приведения типов пакета по колонкам"""
+        if not pack:
+            return pack
+        columns = list(zip(*pack))
+        for i, converter in enumerate(self.converters):
+            if converter is not None:
+                columns[i] = [converter(value) for value in columns[i]]
+        return list(zip(*columns))
+
+
+def column_converter(data_type: str, nullable: bool) -> Optional[Callable]:
+    """Метод для выбора конвертера колонки по типу Postgres"""
+    if data_type in TEXT_TYPES:
+        return empty_to_null if nullable else null_to_empty
+    return TYPE_CONVERTERS.get(data_type)
+
+
+def build_mappings(
+    connection: sqlite3.Connection,
+    pg_conn: _connection,
+    tables: list
+        ) -> dict:
+    """
+    Метод для построения соответствий колонок всех таблиц
+    по именам с учётом COLUMN_OVERRIDES. Расхождения схем
+    логируются до начала загрузки, таблицы без пары в Postgres
+    пропускаются, а отсутствие обязательной колонки останавливает перенос
+    """
+    with pg_conn.cursor() as pg_cursor:
+        pg_cursor.execute(POSTGRES_COLUMNS_QUERY)
+        rows = pg_cursor.fetchall()
+    pg_conn.commit()
+    postgres = {}
+    for table, column, data_type, is_nullable, default in rows:
+        postgres.setdefault(table, {})[column] = (data_type, is_nullable == 'YES', default)
+
+    mappings = {}
+    errors = []
+    cursor = connection.cursor()
+    try:
+        for table in tables:
+            if table not in postgres:
+                logger.warning(f'Table {table} is not in Postgres, skipped')
+                continue
+            cursor.execute(f'PRAGMA table_info({table})')
+            sqlite_columns = [row[1] for row in cursor.fetchall()]
+            pg_columns = postgres[table]
+
+            pairs = []
+            for column in sqlite_columns:
+                target = COLUMN_OVERRIDES.get(column, column)
+                if target not in pg_columns and column in pg_columns:
+                    target = column
+                if target in pg_columns:
+                    pairs.append((column, target))
+                else:
+                    logger.warning(f'Column {table}.{column} is not in Postgres, skipped')
+
+            mapped = {target for _, target in pairs}
+            for column, (_, nullable, default) in pg_columns.items():
+                if column in mapped:
+                    continue
+                if nullable or default is not None:
+                    logger.info(f'Column {table}.{column} is not in SQLite, default is used')
+                else:
+                    errors.append(f'{table}.{column}')
+
+            mappings[table] = TableMapping(
+                table,
+                [column for column, _ in pairs],
+                [target for _, target in pairs],
+                [column_converter(*pg_columns[target][:2]) for _, target in pairs]
+            )
+            logger.info(
+                f'Table {table} mapped: ' +
+                ', '.join(f'{column}->{target}' for column, target in pairs)
+            )
+    finally:
+        cursor.close()
+
+    if errors:
+        raise ValueError(f'Required Postgres columns missing in SQLite: {", ".join(errors)}')
+    return mappings
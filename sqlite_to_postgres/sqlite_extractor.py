@@ -1,12 +1,22 @@
 import logging
 import sqlite3
 from contextlib import contextmanager
-from typing import Tuple
+from typing import Optional, Tuple
+
+from migration_checkpoint import MigrationCheckpoint
 
 
 class SQLiteExtractor:
-    def __init__(self, connection: sqlite3.Connection):
+    def __init__(
+        self,
+        connection: sqlite3.Connection,
+        pack_size: int = 1000,
+        mappings: Optional[dict] = None
+            ):
         self.connection = connection
+        self.pack_size = pack_size
+        # соответствия колонок из schema_mapping.build_mappings
+        self.mappings = mappings or {}
         self.logger = logging.getLogger(__name__)
 
     @contextmanager
@@ -33,20 +43,53 @@ class SQLiteExtractor:
             self.logger.info(f'Finished! Extracted {len(tables)} tables')
             return [table[0] for table in tables]
 
-    def extract_pack(self) -> Tuple[str, list]:
-        """Генератор для извлечения данных из SQLite по пакетам"""
-        tables = self.extract_table_names()
+    def extract_pack(
+        self,
+        checkpoint: Optional[MigrationCheckpoint] = None
+            ) -> Tuple[str, int, int, list]:
+        """
+        Генератор для извлечения данных из SQLite по пакетам.
+        С checkpoint каждая таблица читается после последнего
+        сохранённого rowid. Вместе с пакетом возвращаются
+        первый и последний rowid пакета
+        """
+        for table in self.mappings:
+            after = checkpoint.get_position(table) if checkpoint else 0
+            for first, last, pack in self.extract_table(table, after):
+                yield (table, first, last, pack)
+
+    def get_columns(self, table: str) -> list:
+        """Метод для получения колонок таблицы SQLite в порядке соответствия"""
+        return self.mappings[table].sqlite_columns
+
+    def extract_table(self, table: str, after: int = 0) -> Tuple[int, int, list]:
+        """
+        Генератор для извлечения одной таблицы из SQLite по пакетам.
+        Каждый пакет читается по ключу rowid > последнего rowid,
+        поэтому продолжение с середины таблицы не перечитывает начало
+        """
+        columns = self.get_columns(table)
+        with self.get_cursor() as sqlite_cursor:
+            while True:
+                sqlite_cursor.execute(
+                    f'SELECT rowid, {",".join(columns)} FROM {table} '
+                    'WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                    (after, self.pack_size)
+                )
+                rows = sqlite_cursor.fetchall()
+                if not rows:
+                    break
+                self.logger.info(f'Extracted pack from {table} table')
+                after = rows[-1][0]
+                yield rows[0][0], after, [row[1:] for row in rows]
 
+    def extract_range(self, table: str, first: int, last: int) -> list:
+        """Метод для извлечения пакета таблицы по диапазону rowid"""
+        columns = self.get_columns(table)
         with self.get_cursor() as sqlite_cursor:
-            for table in tables:
-                sqlite_cursor.execute(f'PRAGMA table_info({table})')
-                columns = [i[1] for i in sqlite_cursor.fetchall()]
-                columns = sorted(columns)
-                sqlite_cursor.execute(f'SELECT {",".join(columns)} FROM {table}')
-                while True:
-                    pack = sqlite_cursor.fetchmany(1000)
-                    if pack:
-                        self.logger.info(f'Extracted pack from {table} table')
-                        yield (table, pack)
-                    else:
-                        break
+            sqlite_cursor.execute(
+                f'SELECT {",".join(columns)} FROM {table} '
+                'WHERE rowid BETWEEN ? AND ? ORDER BY rowid',
+                (first, last)
+            )
+            return sqlite_cursor.fetchall()